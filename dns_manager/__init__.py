@@ -1,26 +1,16 @@
-import dataclasses
-import datetime
+import asyncio
 import os
-from json import JSONEncoder
 import logging
 from flask import Flask, has_request_context, request
 from flask.logging import default_handler
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
-login_manager = LoginManager()
+from . import database
+from .json_provider import FastJSONProvider
 
-class CustomJSONEncoder(JSONEncoder):
-    def default(self, o):
-        if type(o) == datetime.timedelta:
-            return str(o)
-        elif type(o) == datetime.datetime:
-            return o.isoformat()
-        elif dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        else:
-            return super().default(o)
+db = SQLAlchemy(session_options={'class_': database.RoutingSession})
+login_manager = LoginManager()
 
 class RequestFormatter(logging.Formatter):
     def format(self, record):
@@ -39,29 +29,76 @@ formatter = RequestFormatter(
 )
 default_handler.setFormatter(formatter)
 
+class DNSManager(Flask):
+    json_provider_class = FastJSONProvider
+
+    def ensure_sync(self, func):
+        """Coroutine views called on a running loop are awaited by their caller, see asgi.py."""
+        if asyncio.iscoroutinefunction(func):
+            try:
+                asyncio.get_running_loop()
+                return func
+            except RuntimeError:
+                pass
+        return super().ensure_sync(func)
+
 def create_app():
-    app = Flask(__name__)
+    app = DNSManager(__name__)
 
     app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_ADDRESS']
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.engine_options(os.environ['DATABASE_ADDRESS'], 'primary')
+    if database.DATABASE_READ_ADDRESS:
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': {'url': database.DATABASE_READ_ADDRESS, **database.engine_options(database.DATABASE_READ_ADDRESS, 'replica')}
+        }
     app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
     app.config['SESSION_COOKIE_HTTPONLY'] = True
     app.config['FLASK_PYDANTIC_VALIDATION_ERROR_RAISE'] = False
-    app.json_encoder = CustomJSONEncoder
 
     db.init_app(app)
     login_manager.init_app(app)
 
     with app.app_context():
+        database.instrument(db.engine, 'primary')
+        if 'replica' in db.engines:
+            database.instrument(db.engines['replica'], 'replica')
+
+        from . import metrics
+        from . import profiling
+        engines = {key or 'primary': engine for key, engine in db.engines.items()}
+        profiling.init_app(app, engines)
+        metrics.init_app(app, engines)
+
         from . import auth
         from . import main
         from . import api
         from . import dns
+        from . import migrations
         app.register_blueprint(auth.auth_bp)
         app.register_blueprint(main.main_bp)
         app.register_blueprint(api.api_bp)
         app.register_blueprint(dns.dns_bp)
+        app.cli.add_command(migrations.upgrade_db_command)
 
-        db.create_all()
+        if migrations.DATABASE_UPGRADE_ON_START:
+            migrations.upgrade()
+        elif migrations.missing() != 0:
+            app.logger.warning('Database schema is missing or outdated, run `flask --app dns_manager upgrade-db`')
 
         return app
+
+
+def after_fork(app):
+    """
+    Re-creates what a worker forked from a preloaded app must not share with its parent:
+    database and BIND connections, background threads and hashing processes. See gunicorn.conf.py.
+    """
+    from . import dns
+    from . import passwords
+    with app.app_context():
+        for engine in db.engines.values():
+            # Leaves the parent's connections open for the parent
+            engine.dispose(close=False)
+    dns.after_fork()
+    passwords.after_fork()
@@ -1,9 +1,18 @@
+import base64
+import datetime
 import json
 from typing import Optional
 from flask import Blueprint, jsonify
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from flask_login import login_required, current_user
+from . import database
+from .profiling import profile_store
 from .models import UserNode, db, user_role, admin_role, node_role, User
 from .auth import roles_required
+from .passwords import PasswordHashingBusy
+from .schemas import NODE_FIELDS, USER_FIELDS, serialize_node, serialize_nodes, serialize_user, serialize_users
 from flask_pydantic import validate
 from pydantic import BaseModel, validator, EmailStr, SecretStr
 
@@ -67,15 +76,91 @@ class UserBodyPut(BaseModel):
         return v
 
 
+class ListQuery(BaseModel):
+    limit: Optional[int] = 0  # rows per page, 0 means all of them
+    cursor: Optional[str] = ""  # X-Next-Cursor of the previous page
+    fields: Optional[str] = ""  # comma separated columns to return, all of them by default
+    domain_prefix: Optional[str] = ""
+    email: Optional[str] = ""  # of the user, or of the owner of nodes
+    created_since: Optional[datetime.datetime]
+    nodes: Optional[bool] = True  # users only, include their nodes unless fields are given
+
+
 api_bp = Blueprint('api_bp', __name__, url_prefix = '/api')
 
 
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([str(row.time_created), row.id]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        time_created, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(time_created), str(id)
+    except Exception:
+        raise ValueError(f"invalid cursor {cursor}")
+
+
+def list_rows(model, query: ListQuery, allowed_fields, statement=None):
+    """
+    One page of model rows ordered by (time_created, id), filtered and projected in SQL.
+    Returns the rows (entities, or dicts of the requested fields) and the cursor of the next page,
+    raises ValueError on an invalid query.
+    """
+    fields = [f.strip() for f in query.fields.split(',') if f.strip()]
+    if any(f not in allowed_fields for f in fields) or query.limit < 0:
+        raise ValueError()
+    # The keyset columns are read even when not requested
+    columns = [getattr(model, f) for f in dict.fromkeys(fields + ['id', 'time_created'])]
+    statement = statement if statement is not None else select(model)
+    statement = statement.with_only_columns(*columns) if fields else statement
+    if query.domain_prefix:
+        statement = statement.where(model.domain.startswith(query.domain_prefix, autoescape=True))
+    if query.email:
+        owner = model if model is User else User
+        if model is not User:
+            statement = statement.join(User, UserNode.user_id == User.id)
+        statement = statement.where(func.lower(owner.email) == query.email.lower())
+    if query.created_since:
+        statement = statement.where(model.time_created >= query.created_since)
+    if query.cursor:
+        time_created, id = decode_cursor(query.cursor)
+        # Compared with the stored value of the cursor row, which does not depend on how the
+        # database formats timestamps, the decoded one only matters once that row is deleted
+        after = func.coalesce(select(model.time_created).where(model.id == id).scalar_subquery(), time_created)
+        statement = statement.where(or_(model.time_created > after, and_(model.time_created == after, model.id > id)))
+    statement = statement.order_by(model.time_created, model.id)
+    if query.limit:
+        statement = statement.limit(query.limit + 1)
+    result = db.session.execute(statement)
+    rows = result.all() if fields else result.scalars().all()
+    next_cursor = None
+    if query.limit and len(rows) > query.limit:
+        rows = rows[:query.limit]
+        next_cursor = encode_cursor(rows[-1])
+    if fields:
+        rows = [{f: getattr(row, f) for f in fields} for row in rows]
+    return rows, next_cursor
+
+
+def listing(rows, next_cursor):
+    return jsonify(rows), 200, {'X-Next-Cursor': next_cursor} if next_cursor else {}
+
+
 @api_bp.route("/user", methods=['GET'])
 @login_required
 @roles_required(admin_role)
-def get_users():
-    users = User.query.all()
-    return jsonify(users), 200
+@validate()
+def get_users(query: ListQuery):
+    statement = select(User)
+    if query.nodes and not query.fields:
+        # One more query for the nodes of the whole page
+        statement = statement.options(selectinload(User.iot_users))
+    try:
+        users, next_cursor = list_rows(User, query, USER_FIELDS, statement)
+    except ValueError:
+        return "", 400
+    return listing(users if query.fields else serialize_users(users, nodes=query.nodes), next_cursor)
 
 
 @api_bp.route("/user", methods=['POST'])
@@ -88,11 +173,14 @@ def add_user(body: UserBodyPost):
         email=body.email,
         domain=body.subdomain
     )
-    user.set_password(body.password.get_secret_value())
+    try:
+        user.set_password(body.password.get_secret_value())
+    except PasswordHashingBusy:
+        return "", 503
     user.generate_api_key()
     db.session.add(user)
     db.session.commit()
-    return jsonify(user), 201
+    return jsonify(serialize_user(user)), 201
 
 
 @api_bp.route("/user/<id>", methods=['GET'])
@@ -102,7 +190,7 @@ def add_user(body: UserBodyPost):
 def get_user(id: str):
     user = User.query.filter_by(id=id).first()
     if user:
-        return jsonify(user), 200
+        return jsonify(serialize_user(user)), 200
     return "", 404
 
 
@@ -131,14 +219,18 @@ def modify_user(id: str, body: UserBodyPut):
             continue
         setattr(user, key, val)
     if body.password:
-        user.set_password(body.password.get_secret_value())
+        try:
+            user.set_password(body.password.get_secret_value())
+        except PasswordHashingBusy:
+            db.session.rollback()
+            return "", 503
     if body.api_key:
         user.generate_api_key()
     try:
         db.session.commit()
     except Exception:
         return "", 400
-    return jsonify(user), 200
+    return jsonify(serialize_user(user)), 200
 
 
 @api_bp.route("/my_user", methods=['GET'])
@@ -166,12 +258,16 @@ def modify_my_user(body: UserBodyPut):
 @api_bp.route("/node", methods=['GET'])
 @login_required
 @roles_required(user_role)
-def get_nodes():
-    if admin_role in current_user.roles_list:
-        nodes = UserNode.query.all()
-    else:
-        nodes = UserNode.query.filter_by(user_id=current_user.id).all()
-    return jsonify(nodes), 200
+@validate()
+def get_nodes(query: ListQuery):
+    statement = select(UserNode)
+    if admin_role not in current_user.roles_list:
+        statement = statement.where(UserNode.user_id == current_user.id)
+    try:
+        nodes, next_cursor = list_rows(UserNode, query, NODE_FIELDS, statement)
+    except ValueError:
+        return "", 400
+    return listing(nodes if query.fields else serialize_nodes(nodes), next_cursor)
 
 
 @api_bp.route("/node", methods=['POST'])
@@ -179,17 +275,20 @@ def get_nodes():
 @roles_required(user_role)
 @validate()
 def register_node(body: NodeBodyPost):
-    if admin_role not in current_user.roles_list and not UserNode.query.filter((UserNode.domain==body.subdomain) & (UserNode.user_id==current_user.id)).first():
-        iot_user = UserNode(
-            user_id=current_user.id,
-            domain=body.subdomain
-        )
-        iot_user.generate_api_key()
-        db.session.add(iot_user)
+    if admin_role in current_user.roles_list:
+        return "", 400
+    iot_user = UserNode(
+        user_id=current_user.id,
+        domain=body.subdomain
+    )
+    iot_user.generate_api_key()
+    db.session.add(iot_user)
+    try:
         db.session.commit()
-        return iot_user.api_key, 201
-    else:
+    except IntegrityError:  # the user already has a node with this domain
+        db.session.rollback()
         return "", 400
+    return iot_user.api_key, 201
 
 
 def check_privileges_and_return_node(id: str):
@@ -210,7 +309,7 @@ def get_node(id: str):
     node = check_privileges_and_return_node(id)
     if not node:
         return "", 404
-    return jsonify(node), 200
+    return jsonify(serialize_node(node)), 200
 
 
 @api_bp.route("/node/<id>", methods=['DELETE'])
@@ -234,17 +333,16 @@ def modify_node(id: str, body: NodeBodyPut):
     node = check_privileges_and_return_node(id)
     if not node:
         return "", 404
-    if body.subdomain and not UserNode.query.filter((UserNode.domain==body.subdomain) & (UserNode.user_id==current_user.id)).first():
-        setattr(node, 'domain', body.subdomain)
-    elif UserNode.query.filter((UserNode.domain==body.subdomain) & (UserNode.user_id==current_user.id)).first():
-        return "", 400
+    if body.subdomain:
+        node.domain = body.subdomain
     if body.api_key:
         node.generate_api_key()
     try:
         db.session.commit()
-    except Exception:
+    except Exception:  # (user_id, domain) is unique
+        db.session.rollback()
         return "", 400
-    return jsonify(node), 200
+    return jsonify(serialize_node(node)), 200
 
 
 @api_bp.route("/my_node", methods=['GET'])
@@ -269,3 +367,28 @@ def delete_my_node():
 @validate()
 def modify_my_node(body: NodeBodyPut):
     return modify_node.__wrapped__.__wrapped__(id=current_user.id, body=body)
+
+
+@api_bp.route("/stats", methods=['GET'])
+@login_required
+@roles_required(admin_role)
+def get_stats():
+    return jsonify({'database': database.stats(db.engines)}), 200
+
+
+@api_bp.route("/profile", methods=['GET'])
+@login_required
+@roles_required(admin_role)
+def get_profiles():
+    """Summaries of the recent request profiles, newest first."""
+    return jsonify(profile_store.get('recent') or []), 200
+
+
+@api_bp.route("/profile/<id>", methods=['GET'])
+@login_required
+@roles_required(admin_role)
+def get_profile(id: str):
+    profile = profile_store.get(id) if id != 'recent' else None
+    if profile is None:
+        return "", 404
+    return jsonify(profile), 200
@@ -0,0 +1,188 @@
+"""
+ASGI entry point, e.g. `uvicorn --factory dns_manager.asgi:create_asgi_app`.
+
+Concurrency model: one event loop per worker process.
+- Async views (the record endpoints of the DNS blueprint) run on that loop, each request in its own task
+  with its own Flask request context, so a process waits on BIND for any number of them at once.
+  Their DNS traffic uses dnspython's asyncio resolver and the loop's own pooled TCP connections,
+  anything else that blocks (zone transfers of snapshots) is moved to a thread.
+- Authentication and flask_pydantic validation stay synchronous and run on the loop too, with the
+  API-key cache a node's request only touches the database on a cache miss.
+- Every other view (pages, users and nodes API, zone transfers) runs on a pool of ASGI_THREADS threads,
+  like it would under a threaded WSGI server.
+- Write-behind flushes and the zone mirror keep their background threads.
+Limit in-flight requests with the server (uvicorn --limit-concurrency), BIND connections of a process
+are bounded by BIND_POOL_SIZE whichever way it is served.
+"""
+import asyncio
+import concurrent.futures
+import inspect
+import io
+import os
+from werkzeug.exceptions import HTTPException
+from flask import request_started
+
+from . import create_app
+from . import helpers
+
+# Threads running synchronous views, per worker process
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+# Worker processes, read by uvicorn when --workers is not given, several are assumed when it is not set
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 0))
+
+
+def wsgi_environ(scope: dict, body: bytes):
+    """WSGI environ of an ASGI HTTP request, as Flask expects it."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf8').decode('latin1'),
+        'PATH_INFO': path.encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else None,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': WEB_CONCURRENCY != 1,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class ASGIApp:
+    """Serves a Flask app over ASGI, awaiting async views on the server's loop, see the module docstring."""
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    self.serve_on_this_loop()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        elif scope['type'] == 'http':
+            self.serve_on_this_loop()
+            body = b''
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    break
+            environ = wsgi_environ(scope, body)
+            if self.is_async(environ):
+                await self.handle_async(environ, send)
+            else:
+                await self.handle_sync(environ, send)
+        elif scope['type'] == 'websocket':
+            await send({'type': 'websocket.close'})
+
+    def serve_on_this_loop(self):
+        if helpers.serving_loop is None:
+            helpers.serving_loop = asyncio.get_running_loop()
+
+    def is_async(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return False  # Flask answers with its error handlers
+        view = self.app.view_functions.get(endpoint)
+        return view is not None and inspect.iscoroutinefunction(inspect.unwrap(view))
+
+    async def handle_sync(self, environ, send):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        app_iter = await loop.run_in_executor(self.executor, self.app, environ, start_response)
+        await self.send_response(send, started, app_iter, blocking=True)
+
+    async def handle_async(self, environ, send):
+        """Same as Flask.wsgi_app, only awaiting the view."""
+        app = self.app
+        ctx = app.request_context(environ)
+        error = None
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        try:
+            try:
+                ctx.push()
+                try:
+                    request_started.send(app)
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = app.dispatch_request()
+                        if inspect.isawaitable(rv):
+                            rv = await rv
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                response = app.handle_exception(e)
+            app_iter = response(environ, start_response)
+        finally:
+            if error is not None and app.should_ignore_error(error):
+                error = None
+            ctx.pop(error)
+        await self.send_response(send, started, app_iter, blocking=response.is_streamed)
+
+    async def send_response(self, send, started, app_iter, blocking):
+        loop = asyncio.get_running_loop()
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in started['headers']],
+        })
+        chunks = iter(app_iter)
+        try:
+            while True:
+                # Streamed bodies (zone transfers) are produced by blocking generators
+                chunk = await loop.run_in_executor(self.executor, next, chunks, None) if blocking else next(chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(app_iter, 'close'):
+                await loop.run_in_executor(self.executor, app_iter.close) if blocking else app_iter.close()
+
+
+def create_asgi_app():
+    app = create_app()
+    from . import dns
+    dns.start_write_behind()
+    return ASGIApp(app)
@@ -1,11 +1,25 @@
 from functools import wraps
+import hmac
 import os
 from flask import Blueprint, current_app, flash, redirect, render_template, request, url_for, g
 from flask_login import current_user, login_user, user_loaded_from_request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, aliased
 
 from . import login_manager
+from .cache import CACHE_BACKEND, make_cache
+from .database import DATABASE_READ_ADDRESS, replica_reads
 from .forms import LoginForm, SignupForm
-from .models import User, db, UserNode, Admin
+from .models import User, db, UserNode, Admin, Credential, Principal, hash_api_key, user_role, node_role
+from .passwords import PasswordHashingBusy
+
+ADMIN_API_KEY = os.environ['ADMIN_API_KEY']
+# API-key hash -> Principal. Rotated and deleted keys are dropped on commit, but only from the cache
+# of the committing process when CACHE_BACKEND is memory: other workers keep accepting them for up to
+# AUTH_CACHE_TTL seconds, which is why it defaults to 5 there and to 60 with a shared backend.
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 5 if CACHE_BACKEND == 'memory' else 60))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+api_key_cache = make_cache('auth', AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
 
 auth_bp = Blueprint('auth_bp', __name__)
 
@@ -24,7 +38,18 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and user.check_password(password=form.password.data):
+        try:
+            valid = user and user.check_password(password=form.password.data)
+        except PasswordHashingBusy:
+            flash('Too many log-in attempts right now, try again in a moment')
+            return redirect(url_for('auth_bp.login'))
+        if valid:
+            if user.password_needs_upgrade():
+                try:
+                    user.set_password(form.password.data)
+                    db.session.commit()
+                except PasswordHashingBusy:
+                    pass  # upgraded on a later log-in
             login_user(user)
             next_page = request.args.get('next')
             return redirect(next_page or url_for('main_bp.dashboard'))
@@ -56,7 +81,11 @@ def signup():
                 email=form.email.data,
                 domain=form.domain.data
             )
-            user.set_password(form.password.data)
+            try:
+                user.set_password(form.password.data)
+            except PasswordHashingBusy:
+                flash('Too many sign-ups right now, try again in a moment')
+                return redirect(url_for('auth_bp.signup'))
             user.generate_api_key()
             db.session.add(user)
             db.session.commit()
@@ -80,24 +109,83 @@ def load_user(user_id):
         return db.session.get(User, user_id)
     return None
 
+def find_principal(key_hash: str):
+    """One lookup of the credential by its hash, joined with whichever principal owns it."""
+    parent = aliased(User)
+    found = (
+        db.session.query(Credential.principal_type, User.id, User.domain, UserNode.id, UserNode.domain, UserNode.user_id, parent.domain)
+        .outerjoin(User, (Credential.principal_type == user_role) & (User.id == Credential.principal_id))
+        .outerjoin(UserNode, (Credential.principal_type == node_role) & (UserNode.id == Credential.principal_id))
+        .outerjoin(parent, parent.id == UserNode.user_id)
+        .filter(Credential.key_hash == key_hash)
+        .first()
+    )
+    if found is None:
+        return None
+    principal_type, user_id, user_domain, node_id, node_domain, node_user_id, parent_domain = found
+    if principal_type == user_role and user_id is not None:
+        return Principal(id=user_id, role=user_role, domain=user_domain)
+    if principal_type == node_role and node_id is not None:
+        return Principal(id=node_id, role=node_role, domain=node_domain, user_id=node_user_id, parent_domain=parent_domain)
+    return None
+
+
 @login_manager.request_loader
 def load_user_from_request(request):
     api_key = request.headers.get('X-Api-Key')
     if api_key:
-        user = User.query.filter_by(api_key=api_key).first()
-        iot_node = UserNode.query.filter_by(api_key=api_key).first()
-        if user is not None:
-            current_app.logger.info('logged in successfully')
-            return db.session.get(User, user.id)
-        elif iot_node is not None:
-            current_app.logger.info('logged in successfully')
-            return db.session.get(UserNode, iot_node.id)
-        elif api_key == os.environ['ADMIN_API_KEY']:
+        if hmac.compare_digest(api_key.encode(), ADMIN_API_KEY.encode()):
             return Admin()
-        else:
-            return None
+        key_hash = hash_api_key(api_key)
+        principal = api_key_cache.get(key_hash)
+        if principal is None:
+            with replica_reads():
+                principal = find_principal(key_hash)
+            if principal is None and DATABASE_READ_ADDRESS:
+                # The replica may not have a freshly generated key yet
+                with replica_reads(False):
+                    principal = find_principal(key_hash)
+            if principal is None:
+                # Misses are not cached, a freshly generated key has to work right away
+                return None
+            api_key_cache.set(key_hash, principal)
+        current_app.logger.info('logged in successfully')
+        return principal
     return None
 
+
+@event.listens_for(Session, 'after_flush')
+def collect_stale_api_keys(session, flush_context):
+    """Remembers cache entries made stale by this flush, they are dropped once it is committed."""
+    stale = session.info.setdefault('stale_api_keys', set())
+    renamed_nodes = []
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Credential) and obj in session.deleted:
+            stale.add(obj.key_hash)
+        elif isinstance(obj, User) and (obj in session.deleted or inspect(obj).attrs.domain.history.has_changes()):
+            stale.add(None)  # cached nodes carry the parent domain, drop everything
+        elif isinstance(obj, UserNode) and inspect(obj).attrs.domain.history.has_changes():
+            renamed_nodes.append(obj.id)
+    if renamed_nodes:
+        with session.no_autoflush:
+            stale.update(key_hash for (key_hash,) in session.query(Credential.key_hash).filter(Credential.principal_id.in_(renamed_nodes)))
+
+
+@event.listens_for(Session, 'after_commit')
+def drop_stale_api_keys(session):
+    stale = session.info.pop('stale_api_keys', set())
+    if None in stale:
+        api_key_cache.clear()
+        return
+    for key_hash in stale:
+        api_key_cache.delete(key_hash)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_stale_api_keys(session):
+    session.info.pop('stale_api_keys', None)
+
+
 @login_manager.unauthorized_handler
 def unauthorized():
     if request.blueprint in ['api_bp', 'dns_bp']:
@@ -0,0 +1,255 @@
+from collections import OrderedDict
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Hashable, Optional
+
+from .metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# Where caches live: 'memory' (per process), 'sqlite:///<path>' (one file shared by the workers of a host)
+# or 'redis://<host>:<port>/<db>' (shared by every replica, needs the redis package).
+# Shared backends pickle cached values, the store must only be writable by dns_manager.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries also expire ttl seconds after being set."""
+
+    def __init__(self, maxsize: int, ttl: float, namespace: str = ''):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.namespace = namespace
+        self._data = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._hit = CACHE_REQUESTS.labels(namespace, 'hit')
+        self._miss = CACHE_REQUESTS.labels(namespace, 'miss')
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: Hashable, default: Any = None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.stats['misses'] += 1
+                self._miss.inc()
+                return default
+            self._data.move_to_end(key)
+            self.stats['hits'] += 1
+            self._hit.inc()
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedCache:
+    """
+    Same interface as TTLCache for caches kept outside the process under a namespace,
+    so deletes and clears are seen by every worker at once.
+    A failing store behaves like an empty cache, failures are counted as errors.
+    """
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'errors': 0}
+        self._hit = CACHE_REQUESTS.labels(namespace, 'hit')
+        self._miss = CACHE_REQUESTS.labels(namespace, 'miss')
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _failed(self, action, e):
+        self._count('errors')
+        logger.warning(f"Cache {self.namespace} {action} failed: {e}")
+
+    def get(self, key: Hashable, default: Any = None):
+        try:
+            raw = self._get(repr(key))
+        except Exception as e:
+            self._failed('get', e)
+            raw = None
+        if raw is None:
+            self._count('misses')
+            self._miss.inc()
+            return default
+        self._count('hits')
+        self._hit.inc()
+        return pickle.loads(raw)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        try:
+            self._set(repr(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ttl)
+        except Exception as e:
+            self._failed('set', e)
+
+    def delete(self, key: Hashable):
+        try:
+            self._delete(repr(key))
+        except Exception as e:
+            self._failed('delete', e)
+
+    def clear(self):
+        try:
+            self._clear()
+        except Exception as e:
+            self._failed('clear', e)
+
+    def __len__(self):
+        try:
+            return self._len()
+        except Exception as e:
+            self._failed('len', e)
+            return 0
+
+
+class SQLiteCache(SharedCache):
+    """
+    Cache in a SQLite file shared by the worker processes of one host.
+    Expired entries are purged every TRIM_EVERY sets, which also evicts the entries
+    closest to expiry once the namespace holds more than maxsize.
+    """
+    TRIM_EVERY = 256
+
+    def __init__(self, path: str, namespace: str, maxsize: int, ttl: float):
+        super().__init__(namespace, maxsize, ttl)
+        self.path = path
+        self._local = threading.local()
+        self._sets = 0
+
+    def _connection(self):
+        # sqlite3 connections belong to one thread, and must not survive a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'namespace TEXT, key TEXT, expires REAL, value BLOB, PRIMARY KEY (namespace, key))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (namespace, expires)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires > ?', (self.namespace, key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, raw, ttl):
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (namespace, key, expires, value) VALUES (?, ?, ?, ?)',
+            (self.namespace, key, time.time() + ttl, raw)
+        )
+        with self._lock:
+            self._sets += 1
+            trim = self._sets % self.TRIM_EVERY == 0
+        if trim:
+            self._trim(conn)
+
+    def _trim(self, conn):
+        conn.execute('DELETE FROM cache WHERE namespace = ? AND expires <= ?', (self.namespace, time.time()))
+        evicted = conn.execute(
+            'DELETE FROM cache WHERE namespace = ? AND key IN ('
+            'SELECT key FROM cache WHERE namespace = ? ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.maxsize)
+        ).rowcount
+        self._count('evictions', evicted)
+
+    def _delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+
+    def _clear(self):
+        self._connection().execute('DELETE FROM cache WHERE namespace = ?', (self.namespace,))
+
+    def _len(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires > ?', (self.namespace, time.time())
+        ).fetchone()[0]
+
+
+class RedisCache(SharedCache):
+    """
+    Cache in a Redis-protocol server shared by every replica.
+    Entries expire on the server, which should also be configured with an LRU maxmemory-policy,
+    maxsize only turns the cache on or off.
+    """
+
+    def __init__(self, url: str, namespace: str, maxsize: int, ttl: float):
+        super().__init__(namespace, maxsize, ttl)
+        import redis  # optional, only this backend needs it
+        self._redis = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._prefix = f'dns_manager:{namespace}:'
+
+    def _get(self, key):
+        return self._redis.get(self._prefix + key)
+
+    def _set(self, key, raw, ttl):
+        self._redis.set(self._prefix + key, raw, px=max(int(ttl * 1000), 1))
+
+    def _delete(self, key):
+        self._redis.delete(self._prefix + key)
+
+    def _clear(self):
+        keys = list(self._redis.scan_iter(match=f'{self._prefix}*', count=1000))
+        if keys:
+            self._redis.delete(*keys)
+
+    def _len(self):
+        return sum(1 for _ in self._redis.scan_iter(match=f'{self._prefix}*', count=1000))
+
+
+def make_cache(namespace: str, maxsize: int, ttl: float):
+    """Cache of the configured CACHE_BACKEND, namespace keeps caches apart in a shared store."""
+    if CACHE_BACKEND.startswith('sqlite:///'):
+        return SQLiteCache(CACHE_BACKEND[len('sqlite:///'):], namespace, maxsize, ttl)
+    if CACHE_BACKEND.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(CACHE_BACKEND, namespace, maxsize, ttl)
+    if CACHE_BACKEND != 'memory':
+        raise ValueError(f"Unknown CACHE_BACKEND {CACHE_BACKEND}")
+    return TTLCache(maxsize, ttl, namespace)
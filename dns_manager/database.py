@@ -0,0 +1,256 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hashlib
+import os
+import threading
+import time
+import sqlalchemy as sa
+from flask import g, has_request_context, request, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.pool import QueuePool
+
+# Connection pool of each worker process, ignored for SQLite which opens a connection per checkout
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+# Seconds to wait for a free connection before failing the request
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+# Connections older than this many seconds are replaced, -1 keeps them forever
+DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+# Test connections on checkout, so ones dropped by the server are replaced instead of failing a request
+DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1'
+# Milliseconds a statement may run on PostgreSQL or MySQL, 0 means no limit
+DATABASE_STATEMENT_TIMEOUT = int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', 0))
+# Optional read replica, used by GET requests and API-key lookups
+DATABASE_READ_ADDRESS = os.environ.get('DATABASE_READ_ADDRESS', '')
+# Seconds after a commit during which its process, and the client that made it, read from the primary.
+# Other workers learn about the client's commit through CACHE_BACKEND, so it has to be shared for them to.
+DATABASE_READ_AFTER_WRITE = float(os.environ.get('DATABASE_READ_AFTER_WRITE', 5))
+# Replication lag (in seconds) above which reads go to the primary, 0 skips the check. PostgreSQL only.
+DATABASE_READ_MAX_LAG = float(os.environ.get('DATABASE_READ_MAX_LAG', 0))
+
+_lock = threading.Lock()  # taken by the pool listeners, never hold it while opening a connection
+_lag_lock = threading.Lock()  # held by the thread checking the replication lag
+counters = {}  # engine name -> its pool counters
+replica_stats = {'replica': 0, 'primary': 0, 'lagging': 0}  # statements sent to each database
+_last_write = float('-inf')
+_lag_checked = float('-inf')
+_lagging = False
+_recent_writes = None  # client -> True for DATABASE_READ_AFTER_WRITE seconds after it committed
+# Set by replica_reads, overriding the choice made from the request method
+_replica_reads = ContextVar('replica_reads', default=None)
+
+
+def _count(name, key, n=1):
+    with _lock:
+        counters[name][key] += n
+
+
+def _route(database):
+    with _lock:
+        replica_stats[database] += 1
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool measuring how long checkouts wait for a connection."""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except sa.exc.TimeoutError:
+            _count(self.logging_name, 'timeouts')
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with _lock:
+                engine_counters = counters[self.logging_name]
+                engine_counters['wait_seconds'] += waited
+                engine_counters['max_wait_seconds'] = max(engine_counters['max_wait_seconds'], waited)
+
+
+def engine_options(uri: str, name: str):
+    """Engine options for the database at uri, name tells its engines apart in stats."""
+    if sa.engine.make_url(uri).get_backend_name() == 'sqlite':
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_logging_name': name,
+        'pool_size': DATABASE_POOL_SIZE,
+        'max_overflow': DATABASE_MAX_OVERFLOW,
+        'pool_timeout': DATABASE_POOL_TIMEOUT,
+        'pool_recycle': DATABASE_POOL_RECYCLE,
+        'pool_pre_ping': DATABASE_POOL_PRE_PING,
+    }
+
+
+def instrument(engine, name: str):
+    """Counts pool events of engine and applies the statement timeout to its connections."""
+    backend = engine.url.get_backend_name()
+    counters[name] = {
+        'checkouts': 0,
+        'in_use': 0,
+        'connects': 0,
+        'invalidated': 0,
+        'timeouts': 0,
+        'wait_seconds': 0.0,
+        'max_wait_seconds': 0.0,
+    }
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        _count(name, 'connects')
+        if DATABASE_STATEMENT_TIMEOUT > 0 and backend in ('postgresql', 'mysql'):
+            setting = 'statement_timeout' if backend == 'postgresql' else 'SESSION max_execution_time'
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET {setting} = {DATABASE_STATEMENT_TIMEOUT}")
+            cursor.close()
+            dbapi_connection.commit()  # or the reset on checkin would roll the setting back
+
+    @sa.event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with _lock:
+            counters[name]['checkouts'] += 1
+            counters[name]['in_use'] += 1
+
+    @sa.event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        _count(name, 'in_use', -1)
+
+    @sa.event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        _count(name, 'invalidated')
+
+
+def stats(engines):
+    """
+    Pool counters of this worker process by engine, with the current size and overflow
+    of bounded pools, and how statements were routed when there is a replica.
+    engines are those of Flask-SQLAlchemy, where the primary has no bind key.
+    """
+    result = {}
+    for key, engine in engines.items():
+        name = key or 'primary'
+        result[name] = dict(counters[name])
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            result[name].update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+    if DATABASE_READ_ADDRESS:
+        result['routing'] = dict(replica_stats)
+    return result
+
+
+@contextmanager
+def replica_reads(allowed: bool = True):
+    """Lets queries of the block read from the replica like those of GET requests, or not at all."""
+    token = _replica_reads.set(allowed)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_lagging(engine):
+    """True when the replica is further behind than DATABASE_READ_MAX_LAG, checked at most once a second."""
+    global _lag_checked, _lagging
+    if DATABASE_READ_MAX_LAG <= 0 or engine.url.get_backend_name() != 'postgresql':
+        return False
+    now = time.monotonic()
+    if now - _lag_checked < 1:
+        return _lagging
+    if not _lag_lock.acquire(blocking=False):
+        return _lagging  # another thread is checking it
+    try:
+        if now - _lag_checked < 1:
+            return _lagging
+        try:
+            with engine.connect() as conn:
+                lag = conn.execute(sa.text(
+                    'SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+                )).scalar()
+            _lagging = lag is not None and lag > DATABASE_READ_MAX_LAG
+        except Exception:
+            _lagging = True  # an unreachable replica is as good as a stale one
+        _lag_checked = now
+    finally:
+        _lag_lock.release()
+    return _lagging
+
+
+class RoutingSession(Session):
+    """
+    Sends reads of GET requests and replica_reads blocks to the 'replica' bind.
+    Writes, reads of a session with pending changes and reads shortly after
+    this process or the client of the request committed go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and 'replica' in self._db.engines and self.reads_from_replica():
+            replica = self._db.engines['replica']
+            if replica_lagging(replica):
+                _route('lagging')
+            else:
+                _route('replica')
+                return replica
+        if 'replica' in self._db.engines:
+            _route('primary')
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+    def reads_from_replica(self):
+        if self._flushing or self.new or self.dirty or self.deleted:
+            return False
+        if time.monotonic() - _last_write < DATABASE_READ_AFTER_WRITE:
+            return False
+        if client_wrote_recently():
+            return False
+        allowed = _replica_reads.get()
+        if allowed is not None:
+            return allowed
+        return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+def recent_writes():
+    global _recent_writes
+    if _recent_writes is None:
+        from .cache import make_cache  # which imports the models, and them this module
+        _recent_writes = make_cache('writes', 100000, DATABASE_READ_AFTER_WRITE)
+    return _recent_writes
+
+
+def client_key():
+    """Who sent the request: its API key, hashed, or the user of its session. None for anonymous ones."""
+    api_key = request.headers.get('X-Api-Key')
+    if api_key:
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()}"
+    user_id = flask_session.get('_user_id')
+    return f"user:{user_id}" if user_id else None
+
+
+def client_wrote_recently():
+    """True when the client of this request committed in the last DATABASE_READ_AFTER_WRITE seconds, on any worker."""
+    if not has_request_context() or DATABASE_READ_AFTER_WRITE <= 0:
+        return False
+    if 'client_wrote_recently' not in g:
+        key = client_key()
+        g.client_wrote_recently = key is not None and recent_writes().get(key) is not None
+    return g.client_wrote_recently
+
+
+@sa.event.listens_for(RoutingSession, 'after_flush')
+def remember_write(session, flush_context):
+    global _last_write
+    _last_write = time.monotonic()
+    session.info['wrote'] = True
+
+
+@sa.event.listens_for(RoutingSession, 'after_commit')
+def remember_client_write(session):
+    if session.info.pop('wrote', False) and DATABASE_READ_ADDRESS and has_request_context():
+        key = client_key()
+        if key is not None:
+            recent_writes().set(key, True)
+            g.client_wrote_recently = True
+
+
+@sa.event.listens_for(RoutingSession, 'after_rollback')
+def forget_write(session):
+    session.info.pop('wrote', None)
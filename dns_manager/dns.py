@@ -1,20 +1,31 @@
+import asyncio
 from collections import defaultdict
 from enum import Enum
 import functools
 import os
-from typing import List, Optional
-from flask import Blueprint, jsonify, request
+import time
+from typing import List, Literal, Optional
+import json
+from flask import Blueprint, Response, current_app, jsonify, request
 from flask_login import current_user, login_required
 from pydantic import BaseModel
 from flask_pydantic import validate
 import dns
+import dns.asyncresolver
+import dns.rcode
+import dns.rdata
 import dns.resolver
 import dns.tsigkeyring
 import dns.update
 import dns.zone
-from .models import node_role, admin_role, user_role, User
+from .models import node_role, admin_role, user_role
 from .auth import roles_required
-from .helpers import logger
+from .cache import make_cache
+from .helpers import logger, on_serving_loop, run_blocking
+from .metrics import bind_timer
+from .pool import ConnectionPool, PoolExhausted
+from .updates import CoalescingQueue
+from .zones import SnapshotStore, ZoneMirror, iterate_zone, select_records
 
 
 # # Allowed record types
@@ -51,58 +62,222 @@ class QueryList(BaseModel):
     record_type: List[str]
 
 
+class BatchOperation(BaseModel):
+    action: Literal['add', 'delete', 'replace']
+    domain: str
+    record_type: str
+    record_value: Optional[str] = ""
+    ttl: Optional[int] = 3600
+    before: Optional[Record]  # replace only, like RecordsSet
+
+
+class RecordsBatch(BaseModel):
+    operations: List[BatchOperation]
+
+
+class ZoneQuery(BaseModel):
+    format: Optional[str] = 'json'  # 'ndjson' streams one record per line
+    prefix: Optional[str] = ""  # only names at or below this one, relative to the zone
+    cursor: Optional[str] = ""  # next_cursor of the previous page
+    limit: Optional[int] = 0  # owner names per page, 0 means the whole zone
+
+
 # Global variables for dns funcs
 DNS_SERVER = os.environ['BIND_SERVER']
+# Port BIND answers queries, updates and zone transfers on
+DNS_PORT = int(os.environ.get('BIND_PORT', 53))
 TSIG = dns.tsigkeyring.from_text({os.environ['TSIG_USERNAME']: os.environ['TSIG_PASSWORD']})
 VALID_ZONE = os.environ['BIND_ALLOWED_ZONES']
+# Single deadline (in seconds) shared by all queries of one lookup request
+DNS_QUERY_DEADLINE = float(os.environ.get('DNS_QUERY_DEADLINE', 5))
+# Types queried by GET /record/<domain> without filters, '*' means every known rdatatype
+INTERESTING_TYPES = os.environ.get('DNS_INTERESTING_TYPES', 'A,AAAA,CNAME,MX,NS,TXT,SOA,PTR,SRV,CAA,TLSA,IOT')
+# Answers of record lookups are cached for their TTL but at most this many seconds, 0 disables it.
+# With the memory CACHE_BACKEND a write only drops the answers cached by the worker process that made it.
+ANSWER_CACHE_TTL = float(os.environ.get('DNS_ANSWER_CACHE_TTL', 0))
+ANSWER_CACHE_SIZE = int(os.environ.get('DNS_ANSWER_CACHE_SIZE', 10000))
+# Serve record lookups from a zone transfer kept for this many seconds, 0 disables it
+ZONE_SNAPSHOT_TTL = float(os.environ.get('DNS_ZONE_SNAPSHOT_TTL', 0))
+# SOA polling interval (in seconds) of the in-memory zone mirror, 0 disables it
+ZONE_MIRROR_INTERVAL = float(os.environ.get('DNS_ZONE_MIRROR_INTERVAL', 0))
+# Kept-alive TCP connections used for UPDATE messages, per worker process
+BIND_POOL_SIZE = int(os.environ.get('BIND_POOL_SIZE', 4))
+BIND_POOL_IDLE_TIMEOUT = float(os.environ.get('BIND_POOL_IDLE_TIMEOUT', 25))
+# Upper bound of a single UPDATE built by the batch endpoint, leaving room for header and TSIG
+DNS_UPDATE_MAX_SIZE = int(os.environ.get('DNS_UPDATE_MAX_SIZE', 60000))
+# Write-behind mode for record creation and modification: flush interval in seconds, 0 disables it.
+# Queued operations are lost on a crash unless a journal path is set, fsync makes them survive power loss too.
+# Queues are per process, when the server runs several worker processes records are written right away.
+WRITE_BEHIND_INTERVAL = float(os.environ.get('DNS_WRITE_BEHIND_INTERVAL', 0))
+WRITE_BEHIND_JOURNAL = os.environ.get('DNS_WRITE_BEHIND_JOURNAL', '')
+WRITE_BEHIND_FSYNC = os.environ.get('DNS_WRITE_BEHIND_FSYNC', '0') == '1'
+# Compare modifications with the published RRset and skip the UPDATE when nothing would change
+SKIP_NOOP_UPDATES = os.environ.get('DNS_SKIP_NOOP_UPDATES', '1') == '1'
 
 # Define blueprint
 dns_bp = Blueprint('dns_bp', __name__, url_prefix='/api/dns')
 
 # Some wrappers
-resolver = dns.resolver.Resolver()
+resolver = dns.asyncresolver.Resolver()
 resolver.nameservers = [DNS_SERVER]
-tcpquery = functools.partial(dns.query.tcp, where=DNS_SERVER)
+resolver.port = DNS_PORT
+bind_pool = ConnectionPool(DNS_SERVER, port=DNS_PORT, size=BIND_POOL_SIZE, timeout=DNS_QUERY_DEADLINE, idle_timeout=BIND_POOL_IDLE_TIMEOUT)
+tcpquery = bind_pool.query
+answer_cache = make_cache('answers', ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)  # (name, type) -> records, NoAnswer or NXDOMAIN
+zone_mirror = ZoneMirror(DNS_SERVER, [VALID_ZONE], ZONE_MIRROR_INTERVAL, timeout=DNS_QUERY_DEADLINE, port=DNS_PORT)
+noop_stats = {'checked': 0, 'skipped': 0}
+snapshots = SnapshotStore(DNS_SERVER, VALID_ZONE, ZONE_SNAPSHOT_TTL, mirror=zone_mirror, port=DNS_PORT)
+
+
+def after_fork():
+    """Per-process state of this module that a worker forked from a preloaded app must not share."""
+    bind_pool.after_fork()
+    write_behind.after_fork()
+    zone_mirror.after_fork()
 
 
 def fix_domain_name(s): return f'{s}.' if not s.endswith('.') else s
 
 
+def interesting_types():
+    if INTERESTING_TYPES.strip() == '*':
+        return [record_type.name for record_type in dns.rdatatype.RdataType]
+    return [t.strip().upper() for t in INTERESTING_TYPES.split(',') if t.strip()]
+
+
+def async_view(func):
+    """
+    Lets flask_pydantic's validate wrap a coroutine: the ASGI server awaits it on its loop,
+    under WSGI Flask runs it to completion on a loop of its own.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return current_app.ensure_sync(func)(*args, **kwargs)
+    return wrapper
+
+
+async def resolve_types(domain: str, record_types: List[str], ignored=(dns.resolver.NoAnswer, dns.resolver.NXDOMAIN)):
+    """
+    Resolve all record_types of domain at once.
+    Every query shares one deadline, those still unanswered then fail with dns.exception.Timeout.
+    Exceptions not listed in ignored are re-raised.
+    """
+    tasks = [asyncio.ensure_future(resolve_type(domain, record_type)) for record_type in record_types]
+    pending = tasks
+    try:
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=DNS_QUERY_DEADLINE)
+    finally:
+        for task in pending:
+            task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    answers = [
+        dns.exception.Timeout() if task.cancelled() else task.exception() or task.result()
+        for task in tasks
+    ]
+    records = {}
+    error = None
+    for record_type, answer in zip(record_types, answers):
+        if not isinstance(answer, BaseException):
+            records[record_type] = answer
+        elif not isinstance(answer, ignored) and error is None:
+            error = answer
+    if error is not None:
+        raise error
+    return records
+
+
+async def resolve_type(domain: str, record_type: str):
+    """Records of one type as text, through answer_cache. Negative answers are cached and raised too."""
+    key = (domain.lower(), record_type.upper())
+    cached = answer_cache.get(key) if answer_cache.enabled else None
+    if cached in (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+        raise cached()
+    if cached is not None:
+        return cached
+    try:
+        with bind_timer('query', f'{domain} {record_type}'):
+            answer = await resolver.resolve(domain, record_type, raise_on_no_answer=False, lifetime=DNS_QUERY_DEADLINE)
+    except dns.resolver.NXDOMAIN as e:
+        if answer_cache.enabled:
+            # The SOA of the response tells how long the name may be considered missing,
+            # without one the NXDOMAIN is not cached
+            try:
+                response = e.response(e.qnames()[0])
+                has_soa = any(rrset.rdtype == dns.rdatatype.SOA for rrset in response.authority)
+                negative_ttl = response.resolve_chaining().minimum_ttl if has_soa else None
+            except Exception:
+                negative_ttl = None
+            if negative_ttl:
+                answer_cache.set(key, dns.resolver.NXDOMAIN, negative_ttl)
+        raise
+    # expiration honours the TTL of the records, or the negative TTL of the SOA
+    ttl = answer.expiration - time.time()
+    if answer.rrset is None:
+        answer_cache.set(key, dns.resolver.NoAnswer, ttl)
+        raise dns.resolver.NoAnswer(response=answer.response)
+    records = [str(x) for x in answer.rrset]
+    answer_cache.set(key, records, ttl)
+    return records
+
+
+def forget_answers(domain: str, *record_types: str):
+    """Drops cached answers a write of these types on domain makes stale, any type for a CNAME."""
+    if not answer_cache.enabled:
+        return
+    if 'CNAME' in (record_type.upper() for record_type in record_types):
+        record_types = [record_type.name for record_type in dns.rdatatype.RdataType]
+    for record_type in record_types:
+        answer_cache.delete((domain.lower(), record_type.upper()))
+
+
+async def exchange(message):
+    """Sends an UPDATE over the pool, without blocking the ASGI server's loop."""
+    with bind_timer('update', f'{sum(len(rrset) or 1 for rrset in message.update)} records'):
+        if on_serving_loop():
+            return await bind_pool.aquery(message)
+        return tcpquery(message)
+
+
+async def snapshot_records(domain: str, record_types: List[str]):
+    """snapshots.records, which may have to transfer the zone first."""
+    return await run_blocking(snapshots.records, domain, record_types) if snapshots.enabled else None
+
+
 @dns_bp.route("/record/<domain>", methods=['GET'])
 @login_required
 @validate()
-def get_all_records(domain: str):
+@async_view
+async def get_all_records(domain: str):
     domain = fix_domain_name(domain)
     if not domain.endswith(VALID_ZONE):
         return "", 400
     
     if request.args:
-        return get_typed_records(domain = domain, query = request.args)
+        return await get_typed_records(domain = domain, query = request.args)
 
-    records = {}
-    for record_type in dns.rdatatype.RdataType:
-        try:
-            answers = resolver.resolve(domain, record_type)
-            records[record_type.name] = [str(x) for x in answers.rrset]
-        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN, dns.exception.DNSException):
-            continue
-        except Exception:
-            return "", 400
+    record_types = interesting_types()
+    records = await snapshot_records(domain, record_types)
+    if records is not None:
+        return jsonify(records), 200
+    try:
+        records = await resolve_types(domain, record_types, ignored=(dns.exception.DNSException,))
+    except Exception:
+        return "", 400
     return jsonify(records), 200
 
 
 @login_required
 @validate()
-def get_typed_records(domain: str, query: QueryList):
-    records = {}
-    for record_type in query.record_type:
-        try:
-            answers = resolver.resolve(domain, record_type)
-            records[record_type] = [str(x) for x in answers.rrset]
-        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            continue
-        except Exception:
-            return "", 400
+@async_view
+async def get_typed_records(domain: str, query: QueryList):
+    records = await snapshot_records(domain, query.record_type)
+    if records is not None:
+        return jsonify(records), 200
+    try:
+        records = await resolve_types(domain, query.record_type)
+    except Exception:
+        return "", 400
     return jsonify(records), 200
 
 
@@ -110,38 +285,195 @@ def update_action():  # helper function
     return dns.update.Update(VALID_ZONE, keyring=TSIG) # this is always the base
 
 
-def check_privileges(domain: str):
+def privilege_checker():
+    """Predicate telling which domains current_user may change, any lookups are done once."""
     if admin_role in current_user.roles_list:
-        return True
+        return lambda domain: True
     elif user_role in current_user.roles_list:
-        if domain.endswith(f"{current_user.domain}.{VALID_ZONE}"):
-            return True
-        else:
-            return False
+        suffix = f"{current_user.domain}.{VALID_ZONE}"
+        return lambda domain: domain.endswith(suffix)
     elif node_role in current_user.roles_list:
-        parent_user = User.query.filter_by(id=current_user.user_id).first()
-        if domain == f"{current_user.domain}.{parent_user.domain}.{VALID_ZONE}":
-            return True
-        else:
-            return False
-    return False
+        # Nodes only authenticate with API keys, the cached Principal already knows its parent's domain
+        # and is dropped from the auth cache when either domain changes
+        node_domain = f"{current_user.domain_path}.{VALID_ZONE}"
+        return lambda domain: domain == node_domain
+    return lambda domain: False
+
+
+def check_privileges(domain: str):
+    return privilege_checker()(domain)
+
+
+def prepare_operation(domain: str, op: BatchOperation):
+    """
+    Update calls performing op, with rdata parsed upfront so invalid values fail on their own,
+    and the approximate size they take on the wire.
+    """
+    name = dns.name.from_text(domain)
+    origin = dns.name.from_text(VALID_ZONE)
+
+    def rdata(record_type, record_value):
+        return dns.rdata.from_text(dns.rdataclass.IN, record_type, record_value, origin)
+
+    if op.action == 'add':
+        calls = [('add', (name, op.ttl, rdata(op.record_type, op.record_value)))]
+    elif op.action == 'delete' and op.record_value:
+        calls = [('delete', (name, rdata(op.record_type, op.record_value)))]
+    elif op.action == 'delete':
+        dns.rdatatype.from_text(op.record_type)
+        calls = [('delete', (name, op.record_type))]
+    elif op.before:
+        calls = [
+            ('delete', (name, rdata(op.before.record_type, op.before.record_value))),
+            ('add', (name, op.ttl, rdata(op.record_type, op.record_value))),
+        ]
+    else:
+        calls = [('replace', (name, op.ttl, rdata(op.record_type, op.record_value)))]
+    # owner name, type, class, ttl and rdlength, plus the rdata itself
+    size = sum(
+        len(name.to_wire()) + 10 + (len(args[-1].to_wire()) if isinstance(args[-1], dns.rdata.Rdata) else 0)
+        for _, args in calls
+    )
+    return calls, size
+
+
+async def send_operations(operations: List[BatchOperation]):
+    """
+    Sends already authorized operations in as few UPDATE messages as fit in DNS_UPDATE_MAX_SIZE.
+    Every message is applied atomically by BIND, so all its operations share one outcome.
+    Returns a status per operation: the code of its single-record endpoint when applied,
+    400 when invalid or refused and 503 when BIND could not be reached.
+    """
+    success = {'add': 201, 'delete': 200, 'replace': 200}
+    statuses = [None] * len(operations)
+    messages = []  # (update, indexes of operations in it, size)
+    for i, op in enumerate(operations):
+        try:
+            calls, size = prepare_operation(op.domain, op)
+        except Exception:
+            statuses[i] = 400
+            continue
+        if not messages or (messages[-1][1] and messages[-1][2] + size > DNS_UPDATE_MAX_SIZE):
+            messages.append((update_action(), [], 0))
+        action, indexes, used = messages[-1]
+        for method, args in calls:
+            getattr(action, method)(*args)
+        indexes.append(i)
+        messages[-1] = (action, indexes, used + size)
+
+    for action, indexes, _ in messages:
+        try:
+            status = None if (await exchange(action)).rcode() == dns.rcode.NOERROR else 400
+        except (OSError, EOFError, dns.exception.Timeout, PoolExhausted):
+            status = 503
+        except Exception:
+            status = 400
+        for i in indexes:
+            statuses[i] = status or success[operations[i].action]
+            op = operations[i]
+            forget_answers(op.domain, op.record_type, *([op.before.record_type] if op.before else []))
+    if messages:
+        snapshots.invalidate(*(operations[i].domain for _, indexes, _ in messages for i in indexes))
+    return statuses
+
+
+def flush_queued(operations: List[dict]):
+    """Flush callback of the write-behind queue, only operations BIND could not receive are retried."""
+    statuses = asyncio.run(send_operations([BatchOperation(**op) for op in operations]))
+    retry = [op for op, status in zip(operations, statuses) if status == 503]
+    rejected = [op for op, status in zip(operations, statuses) if status == 400]
+    return retry, rejected
+
+
+write_behind = CoalescingQueue(flush_queued, WRITE_BEHIND_INTERVAL, journal=WRITE_BEHIND_JOURNAL, fsync=WRITE_BEHIND_FSYNC,
+                               shared=make_cache('write_behind', 16, 60))
+_write_behind_refused = False
+
+
+@dns_bp.before_app_request
+def start_write_behind():
+    """Starts the write-behind queue of this worker, replaying what dead workers left in their journals."""
+    if write_behind.enabled:
+        write_behind.start()
+
+
+def queue_writes():
+    """
+    True when the record endpoints queue their writes. Two workers could send queued operations
+    on the same name in the wrong order, so with several worker processes they are written right away.
+    """
+    global _write_behind_refused
+    if not write_behind.enabled:
+        return False
+    if request.environ.get('wsgi.multiprocess'):
+        if not _write_behind_refused:
+            _write_behind_refused = True
+            logger.warning("DNS_WRITE_BEHIND_INTERVAL ignored, the server runs several worker processes")
+        return False
+    return True
+
+
+async def published_rrset(domain: str, record_type: str):
+    with bind_timer('query', f'{domain} {record_type}'):
+        answer = await resolver.resolve(domain, record_type, raise_on_no_answer=False, lifetime=DNS_QUERY_DEADLINE)
+    # An alias answers with the records of its target, which are not the ones we would change
+    if answer.rrset is None or answer.rrset.name != dns.name.from_text(domain):
+        return None
+    return answer.rrset
+
+
+async def is_noop(domain: str, body: RecordsSet):
+    """True when applying body would leave the published records exactly as they are."""
+    origin = dns.name.from_text(VALID_ZONE)
+    after = body.after
+    wanted = dns.rdata.from_text(dns.rdataclass.IN, after.record_type, after.record_value, origin)
+    try:
+        current = await published_rrset(domain, after.record_type)
+    except dns.resolver.NXDOMAIN:
+        return False
+    # A new TTL is a change too, BIND applies it to the whole RRset
+    if current is None or current.ttl != after.ttl or wanted not in current:
+        return False
+    if body.before is None:
+        return len(current) == 1
+    unwanted = dns.rdata.from_text(dns.rdataclass.IN, body.before.record_type, body.before.record_value, origin)
+    if unwanted == wanted:
+        return True
+    if unwanted.rdtype != wanted.rdtype:
+        current = await published_rrset(domain, body.before.record_type)
+    return current is None or unwanted not in current
+
+
+def enqueue_operation(op: BatchOperation):
+    """Validates op and queues it for the next write-behind flush."""
+    prepare_operation(op.domain, op)
+    write_behind.put(op.dict())
 
 
 @dns_bp.route("/record/<domain>", methods=['POST'])
 @login_required
 @roles_required(node_role)
 @validate()
-def create_record(domain: str, body: Record):
+@async_view
+async def create_record(domain: str, body: Record):
     logger.info("Record creation")
     domain = fix_domain_name(domain)
     if check_privileges(domain) is False:
         return "", 401
+    if queue_writes():
+        try:
+            enqueue_operation(BatchOperation(action='add', domain=domain, **body.dict()))
+        except Exception:
+            return "", 400
+        return "", 202
     action = update_action()
     action.add(dns.name.from_text(domain), body.ttl, body.record_type, body.record_value)
     try:
-        tcpquery(action)
+        await exchange(action)
     except Exception as e:
         return "", 400
+    snapshots.invalidate(domain)
+    forget_answers(domain, body.record_type)
     return "", 201
 
 
@@ -149,20 +481,30 @@ def create_record(domain: str, body: Record):
 @login_required
 @roles_required(node_role)
 @validate()
-def delete_record(domain: str, body: RecordDelete):
+@async_view
+async def delete_record(domain: str, body: RecordDelete):
     logger.info("Record deleting")
     domain = fix_domain_name(domain)
     if check_privileges(domain) is False:
         return "", 401
+    if queue_writes():
+        # Queued like creates and changes, so it is sent after those queued before it
+        try:
+            enqueue_operation(BatchOperation(action='delete', domain=domain, **body.dict()))
+        except Exception:
+            return "", 400
+        return "", 202
     action = update_action()
     if body.record_value:
         action.delete(dns.name.from_text(domain), body.record_type, body.record_value)
     else:
         action.delete(dns.name.from_text(domain), body.record_type)
     try:
-        tcpquery(action)
+        await exchange(action)
     except Exception:
         return "", 400
+    snapshots.invalidate(domain)
+    forget_answers(domain, body.record_type)
     return "", 200
 
 
@@ -170,11 +512,27 @@ def delete_record(domain: str, body: RecordDelete):
 @login_required
 @roles_required(node_role)
 @validate()
-def modify_record(domain: str, body: RecordsSet):
+@async_view
+async def modify_record(domain: str, body: RecordsSet):
     logger.info("Record modify")
     domain = fix_domain_name(domain)
     if check_privileges(domain) is False:
         return "", 401
+    if SKIP_NOOP_UPDATES and not write_behind.pending(domain, body.after.record_type):
+        noop_stats['checked'] += 1
+        try:
+            noop = await is_noop(domain, body)
+        except Exception:
+            noop = False
+        if noop:
+            noop_stats['skipped'] += 1
+            return jsonify(body.after.dict()), 200, {'X-Update-Skipped': 'unchanged'}
+    if queue_writes():
+        try:
+            enqueue_operation(BatchOperation(action='replace', domain=domain, before=body.before, **body.after.dict()))
+        except Exception:
+            return "", 400
+        return jsonify(body.after.dict()), 202
     action = update_action()
     if body.before:
         action.delete(dns.name.from_text(domain), body.before.record_type, body.before.record_value)
@@ -182,41 +540,127 @@ def modify_record(domain: str, body: RecordsSet):
     else:
         action.replace(dns.name.from_text(domain), body.after.ttl, body.after.record_type, body.after.record_value)
     try:
-        tcpquery(action)
+        await exchange(action)
     except Exception:
         return "", 400
+    snapshots.invalidate(domain)
+    forget_answers(domain, body.after.record_type, *([body.before.record_type] if body.before else []))
     return jsonify(body.after.dict()), 200
 
 
+@dns_bp.route("/records:batch", methods=['POST'])
+@login_required
+@roles_required(node_role)
+@validate()
+@async_view
+async def batch_records(body: RecordsBatch):
+    """Applies many record operations at once, see send_operations."""
+    logger.info("Records batch")
+    is_allowed = privilege_checker()
+    statuses = [None] * len(body.operations)
+    allowed = []
+    for i, op in enumerate(body.operations):
+        domain = fix_domain_name(op.domain)
+        if not domain.endswith(VALID_ZONE):
+            statuses[i] = 400
+        elif not is_allowed(domain):
+            statuses[i] = 401
+        else:
+            allowed.append(i)
+    operations = [body.operations[i].copy(update={'domain': fix_domain_name(body.operations[i].domain)}) for i in allowed]
+    # Operations still queued for the same records were requested earlier, they must reach BIND first
+    if any(write_behind.pending(op.domain, record_type) for op in operations
+           for record_type in (op.record_type, *([op.before.record_type] if op.before else []))):
+        await asyncio.to_thread(write_behind.flush)
+    sent = await send_operations(operations)
+    for i, status in zip(allowed, sent):
+        statuses[i] = status
+
+    results = [
+        {'domain': op.domain, 'action': op.action, 'record_type': op.record_type, 'status': status}
+        for op, status in zip(body.operations, statuses)
+    ]
+    return jsonify(results), 200
+
+
+@dns_bp.route("/stats", methods=['GET'])
+@login_required
+@roles_required(admin_role)
+def get_stats():
+    return jsonify({
+        'pool': bind_pool.stats,
+        'write_behind': write_behind.stats,
+        'noop': noop_stats,
+        'answers': answer_cache.stats,
+    }), 200
+
+
+@dns_bp.route("/flush", methods=['POST'])
+@login_required
+@roles_required(admin_role)
+def flush_write_behind():
+    """
+    Sends every write-behind operation queued in this worker right away, the other workers
+    flush within a second when they share the CACHE_BACKEND.
+    """
+    return jsonify({'flushed': write_behind.request_flush(), 'pending': write_behind.stats['pending']}), 200
+
+
 @dns_bp.route("/zone/<domain>", methods=['GET'])
 @login_required
 @roles_required(admin_role)
 @validate()
-def get_zone(domain: str):
+def get_zone(domain: str, query: ZoneQuery):
     result = {}
     records = defaultdict(list)
 
     domain = fix_domain_name(domain)
-    if not domain.endswith(VALID_ZONE):
+    if not domain.endswith(VALID_ZONE) or query.format not in ('json', 'ndjson') or query.limit < 0:
+        return "", 400
+    try:
+        prefix = dns.name.from_text(query.prefix, origin=None) if query.prefix else None
+        cursor = dns.name.from_text(query.cursor, origin=None) if query.cursor else None
+    except dns.exception.DNSException:
         return "", 400
 
-    zone = dns.zone.from_xfr(dns.query.xfr(DNS_SERVER, domain))
-    for (name, ttl, rdata) in zone.iterate_rdatas():
-        if type(rdata.rdtype) != int:
-            if rdata.rdtype.name == 'SOA':
-                result['SOA'] = {
-                    'ttl': ttl,
-                }
-                for n in ('expire', 'minimum', 'refresh', 'retry', 'rname', 'mname', 'serial'):
-                    if n in ('rname', 'mname'):
-                        result['SOA'][n] = str(getattr(rdata, n))
-                    else:
-                        result['SOA'][n] = getattr(rdata, n)
-            else:
-                records[str(name)].append({
+    zone = zone_mirror.get(domain) if zone_mirror.enabled else None
+    source = 'mirror' if zone is not None else 'transfer'
+    (soa_ttl, soa), rdatas = iterate_zone(DNS_SERVER, domain, zone, DNS_PORT)
+    rdatas, next_cursor = select_records(rdatas, prefix=prefix, cursor=cursor, limit=query.limit)
+    rdatas = (
+        (name, ttl, rdata) for (name, ttl, rdata) in rdatas
+        if type(rdata.rdtype) != int and rdata.rdtype.name != 'SOA'
+    )
+    headers = {'X-Zone-Serial': str(soa.serial), 'X-Zone-Source': source}
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+
+    if query.format == 'ndjson':
+        def generate():
+            for (name, ttl, rdata) in rdatas:
+                yield json.dumps({
+                    'name': str(name),
                     'response': str(rdata),
                     'rrtype': rdata.rdtype.name,
                     'ttl': ttl,
-                })
+                }) + '\n'
+        return Response(generate(), 200, headers, mimetype='application/x-ndjson')
+
+    result['SOA'] = {
+        'ttl': soa_ttl,
+    }
+    for n in ('expire', 'minimum', 'refresh', 'retry', 'rname', 'mname', 'serial'):
+        if n in ('rname', 'mname'):
+            result['SOA'][n] = str(getattr(soa, n))
+        else:
+            result['SOA'][n] = getattr(soa, n)
+    for (name, ttl, rdata) in rdatas:
+        records[str(name)].append({
+            'response': str(rdata),
+            'rrtype': rdata.rdtype.name,
+            'ttl': ttl,
+        })
     result['records'] = records
-    return jsonify(result), 200
+    if query.limit:
+        result['next_cursor'] = next_cursor
+    return jsonify(result), 200, headers
@@ -61,4 +61,9 @@ class LoginForm(FlaskForm):
         ]
     )
     password = PasswordField('Password', validators=[InputRequired()])
-    submit = SubmitField('Log In')
\ No newline at end of file
+    submit = SubmitField('Log In')
+
+
+class ApiKeyForm(FlaskForm):
+    """Api-key Regeneration Form."""
+    submit = SubmitField('Generate new api-key')
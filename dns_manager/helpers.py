@@ -1,4 +1,26 @@
+import asyncio
 from werkzeug.local import LocalProxy
 from flask import current_app
 
-logger = LocalProxy(lambda: current_app.logger)
\ No newline at end of file
+logger = LocalProxy(lambda: current_app.logger)
+
+# Event loop of the ASGI server in this process (see asgi.py), None when served over WSGI
+serving_loop = None
+
+
+def on_serving_loop():
+    """
+    True when running on the ASGI server's loop, shared by every request of the process.
+    Async views served over WSGI get a loop of their own, which blocking calls do not hurt.
+    """
+    try:
+        return serving_loop is not None and asyncio.get_running_loop() is serving_loop
+    except RuntimeError:
+        return False
+
+
+async def run_blocking(func, *args):
+    """Runs a blocking func on a thread when the serving loop must not wait for it."""
+    if on_serving_loop():
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
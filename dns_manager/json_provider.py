@@ -0,0 +1,80 @@
+"""
+JSON provider of the app, encoding with orjson when it is installed and with the stdlib json module otherwise.
+
+Both produce the same output: sorted keys, ASCII only, datetimes in ISO format, timedeltas as str()
+and dataclasses (the models) as objects of their fields. orjson cannot escape non-ASCII characters,
+sort non-string keys or encode integers beyond 64 bits, such values are encoded by the stdlib instead.
+The two still differ on floats below 1e-4 or from 1e16, which orjson writes in another but equal
+notation, and on NaN and infinities, which orjson writes as null.
+"""
+import dataclasses
+import datetime
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encoders of the types json cannot encode by itself, by exact type, the dataclasses are added on first use
+_encoders = {
+    datetime.timedelta: str,
+    datetime.datetime: datetime.datetime.isoformat,
+}
+
+
+def dataclass_encoder(cls):
+    """Encoder of the instances of the dataclass cls, nested values are encoded as they come."""
+    names = tuple(field.name for field in dataclasses.fields(cls))
+    return lambda o: {name: getattr(o, name) for name in names}
+
+
+def default(o):
+    encode = _encoders.get(type(o))
+    if encode is None:
+        if not dataclasses.is_dataclass(type(o)):
+            raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+        encode = _encoders[type(o)] = dataclass_encoder(type(o))
+    return encode(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    default = staticmethod(default)
+    # Set to False to encode with the stdlib only, see dns_manager/tests/json_benchmark.py
+    use_orjson = orjson is not None
+
+    def encode(self, obj, indent: bool = False):
+        """obj encoded by orjson, None when only the stdlib can encode it as expected."""
+        if not self.use_orjson:
+            return None
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            data = orjson.dumps(obj, default=self.default, option=option)
+        except orjson.JSONEncodeError:
+            return None
+        return data if data.isascii() or not self.ensure_ascii else None
+
+    def dumps(self, obj, **kwargs):
+        # orjson only has the compact and the indented layout
+        if kwargs == {'separators': (',', ':')} or kwargs == {'indent': 2}:
+            data = self.encode(obj, indent='indent' in kwargs)
+            if data is not None:
+                return data.decode()
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if self.use_orjson and not kwargs:
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass  # NaN, infinities and integers beyond 64 bits, or invalid
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        data = self.encode(self._prepare_response_obj(args, kwargs), indent)
+        if data is None:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
@@ -1,20 +1,39 @@
 from flask import Blueprint, redirect, render_template, url_for
 from flask_login import current_user, login_required, logout_user
 
+from .forms import ApiKeyForm
+from .models import User, db
+
 main_bp = Blueprint('main_bp', __name__)
 
 @main_bp.route('/dashboard', methods=['GET'])
 @login_required
-def dashboard():
+def dashboard(api_key=None):
     """Logged-in User Dashboard."""
     return render_template(
         'dashboard.jinja2',
         title='Dashboard.',
         template='dashboard-template',
         current_user=current_user,
+        form=ApiKeyForm(),
+        api_key=api_key,
         body="You are now logged in!"
     )
 
+@main_bp.route('/dashboard/api_key', methods=['POST'])
+@login_required
+def regenerate_api_key():
+    """
+    Api-keys are stored hashed, so the only moment to show one is right after it is generated.
+    """
+    form = ApiKeyForm()
+    user = db.session.get(User, current_user.id)
+    if not form.validate_on_submit() or user is None:
+        return redirect(url_for('main_bp.dashboard'))
+    user.generate_api_key()
+    db.session.commit()
+    return dashboard(api_key=user.api_key)
+
 @main_bp.route("/logout")
 @login_required
 def logout():
@@ -0,0 +1,148 @@
+"""
+Prometheus metrics, served by GET /metrics.
+
+Under gunicorn (or uvicorn --workers) set PROMETHEUS_MULTIPROC_DIR to a directory only this service uses:
+every worker then writes its samples there and whichever worker answers a scrape adds them all up.
+gunicorn.conf.py empties it on start and drops the gauges of workers that exit.
+"""
+from contextlib import contextmanager
+import hmac
+import os
+import time
+import dns.rdatatype
+import dns.resolver
+import sqlalchemy as sa
+from flask import Blueprint, Response, g, has_request_context, request
+from flask_login import current_user
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY
+
+from .models import admin_role
+
+# Scrapers sending "Authorization: Bearer <token>" may read /metrics, so may the admin API key
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+REQUEST_DURATION = Histogram(
+    'dns_manager_http_request_duration_seconds', 'Time to handle a request, by route.',
+    ['method', 'route', 'status'],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'dns_manager_http_requests_in_flight', 'Requests being handled.', multiprocess_mode='livesum',
+)
+BIND_DURATION = Histogram(
+    'dns_manager_bind_duration_seconds', 'Round trip of an exchange with BIND, whole transfers for xfr.', ['op'],
+)
+BIND_ERRORS = Counter('dns_manager_bind_errors_total', 'Exchanges with BIND that failed.', ['op'])
+DB_QUERY_DURATION = Histogram(
+    'dns_manager_db_query_duration_seconds', 'Time to execute one SQL statement.', ['engine'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    'dns_manager_db_queries_per_request', 'SQL statements executed by one request, by route.', ['route'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+DB_SECONDS_PER_REQUEST = Histogram(
+    'dns_manager_db_seconds_per_request', 'Time one request spent executing SQL statements, by route.', ['route'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+CACHE_REQUESTS = Counter('dns_manager_cache_requests_total', 'Cache lookups, by cache and result.', ['cache', 'result'])
+
+metrics_bp = Blueprint('metrics_bp', __name__)
+
+
+# Called with (op, detail, start, end, error) after every exchange with BIND, see profiling.py
+exchange_listeners = []
+
+
+@contextmanager
+def bind_timer(op: str, detail: str = ''):
+    """Times the exchange with BIND in the block, op is query, update or xfr and detail what was asked."""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except (GeneratorExit, dns.resolver.NXDOMAIN, dns.rdatatype.UnknownRdatatype):
+        raise  # a transfer its consumer stopped reading, an answer, or a query that was never sent
+    except BaseException as e:
+        error = e
+        BIND_ERRORS.labels(op).inc()
+        raise
+    finally:
+        end = time.perf_counter()
+        BIND_DURATION.labels(op).observe(end - start)
+        for listener in exchange_listeners:
+            listener(op, detail, start, end, error)
+
+
+def route():
+    return request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+
+def before_request():
+    g.metrics_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def teardown_request(exc):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return  # before_request did not run
+    REQUESTS_IN_FLIGHT.dec()
+    status = g.pop('metrics_status', 500)
+    REQUEST_DURATION.labels(request.method, route(), str(status)).observe(time.perf_counter() - start)
+    DB_QUERIES_PER_REQUEST.labels(route()).observe(g.db_queries)
+    DB_SECONDS_PER_REQUEST.labels(route()).observe(g.db_seconds)
+
+
+def instrument_engine(engine, name: str):
+    """Times every statement of engine, adding them up per request."""
+    duration = DB_QUERY_DURATION.labels(name)
+
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+        duration.observe(elapsed)
+        if has_request_context() and 'db_queries' in g:
+            g.db_queries += 1
+            g.db_seconds += elapsed
+
+
+def init_app(app, engines):
+    """Times the requests of app and the statements of its engines, by engine name."""
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    for name, engine in engines.items():
+        instrument_engine(engine, name)
+    app.register_blueprint(metrics_bp)
+
+
+def authorized():
+    header = request.headers.get('Authorization', '')
+    if METRICS_TOKEN and header.startswith('Bearer '):
+        return hmac.compare_digest(header[len('Bearer '):].encode(), METRICS_TOKEN.encode())
+    return current_user.is_authenticated and admin_role in current_user.roles_list
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not authorized():
+        return "", 401
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
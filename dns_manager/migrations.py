@@ -0,0 +1,131 @@
+import os
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+
+from .models import Credential, User, UserNode, db, hash_api_key, node_role, user_role
+
+# Create or migrate the schema in every create_app, instead of once with the upgrade-db command
+DATABASE_UPGRADE_ON_START = os.environ.get('DATABASE_UPGRADE_ON_START', '0') == '1'
+
+# Number of migrations applied to the database, in a table of its own
+schema_version = sa.Table('schema_version', sa.MetaData(), sa.Column('version', sa.Integer, nullable=False))
+
+
+def drop_column(table_name: str, column: str):
+    table = db.metadata.tables[table_name]
+    with db.engine.begin() as conn:
+        if conn.dialect.name != 'sqlite':
+            conn.execute(sa.text(f'ALTER TABLE "{table_name}" DROP COLUMN "{column}"'))
+            return
+        # SQLite cannot drop UNIQUE columns, so the table is rebuilt from its model.
+        # Other tables are copied along for its foreign keys to resolve.
+        metadata = sa.MetaData()
+        for other in db.metadata.sorted_tables:
+            if other is not table:
+                other.to_metadata(metadata)
+        rebuilt = table.to_metadata(metadata, name=f'{table_name}__new')
+        # Without the model's indexes, which are for migrations to add
+        conn.execute(sa.schema.CreateTable(rebuilt))
+        columns = ', '.join(f'"{c.name}"' for c in table.columns)
+        conn.execute(sa.text(f'INSERT INTO "{rebuilt.name}" ({columns}) SELECT {columns} FROM "{table_name}"'))
+        conn.execute(sa.text(f'DROP TABLE "{table_name}"'))
+        conn.execute(sa.text(f'ALTER TABLE "{rebuilt.name}" RENAME TO "{table_name}"'))
+
+
+def migrate_plaintext_api_keys():
+    """Moves plaintext api_key columns of users and nodes into hashed credentials and drops them."""
+    migrated = 0
+    for table_name, principal_type in (('user', user_role), ('user_node', node_role)):
+        if 'api_key' not in [c['name'] for c in sa.inspect(db.engine).get_columns(table_name)]:
+            continue
+        rows = db.session.execute(sa.text(f'SELECT id, api_key FROM "{table_name}"')).all()
+        for principal_id, api_key in rows:
+            key_hash = hash_api_key(api_key)
+            if api_key and db.session.get(Credential, key_hash) is None:
+                db.session.add(Credential(key_hash=key_hash, principal_type=principal_type, principal_id=principal_id))
+                migrated += 1
+        db.session.commit()
+        drop_column(table_name, 'api_key')
+    return migrated
+
+
+def hash_api_keys():
+    """API keys stored in plaintext by earlier versions become hashed credentials, they keep working."""
+    Credential.__table__.create(db.engine, checkfirst=True)
+    migrate_plaintext_api_keys()
+
+
+def index_user_nodes():
+    """Indexes user_node lookups and makes (user_id, domain) unique."""
+    duplicates = db.session.execute(sa.text(
+        'SELECT user_id, domain FROM user_node GROUP BY user_id, domain HAVING COUNT(*) > 1'
+    )).all()
+    if duplicates:
+        listed = ', '.join(f"{domain} of user {user_id}" for user_id, domain in duplicates)
+        raise click.ClickException(f"Rename or delete duplicated nodes before upgrading: {listed}")
+    for index in UserNode.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def index_listing_order():
+    """Indexes the (time_created, id) order listings are paged by."""
+    for model in (User, UserNode):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+# Brings databases created by earlier versions up to date, in order. Only ever append to it.
+MIGRATIONS = [
+    hash_api_keys,
+    index_user_nodes,
+    index_listing_order,
+]
+
+
+def set_version(version: int):
+    with db.engine.begin() as conn:
+        conn.execute(schema_version.delete())
+        conn.execute(schema_version.insert().values(version=version))
+
+
+def upgrade():
+    """
+    Creates the schema of an empty database, or applies the migrations it is missing.
+    Databases from before schema_version existed are migrated from the start.
+    Returns the names of the applied migrations.
+    """
+    tables = sa.inspect(db.engine).get_table_names()
+    if schema_version.name not in tables:
+        schema_version.create(db.engine)
+        if 'user' not in tables:
+            db.create_all()
+            set_version(len(MIGRATIONS))
+            return []
+        set_version(0)
+    with db.engine.connect() as conn:
+        version = conn.execute(sa.select(schema_version.c.version)).scalar() or 0
+    applied = []
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration()
+        set_version(number)
+        applied.append(migration.__name__)
+    return applied
+
+
+def missing():
+    """Number of migrations the database lacks, None when it has no schema_version yet."""
+    try:
+        with db.engine.connect() as conn:
+            version = conn.execute(sa.select(schema_version.c.version)).scalar() or 0
+    except sa.exc.DBAPIError:
+        return None
+    return len(MIGRATIONS) - version
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """Create or migrate the database schema."""
+    applied = upgrade()
+    click.echo(f"Applied {', '.join(applied)}" if applied else "Database schema is up to date")
@@ -1,17 +1,62 @@
+import hashlib
+import hmac
 import os
 import uuid
 from flask_login import UserMixin
-from sqlalchemy import DateTime, func
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import DateTime, event, func
+from sqlalchemy.orm import Session
 import secrets
 from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
 
 from . import db
+from .passwords import hash_password, needs_upgrade, verify_password
 
 node_role = 'Node'
 user_role = 'User'
 admin_role = 'Admin'
 
+# Changing this key invalidates every issued API key
+API_KEY_HMAC_KEY = (os.environ.get('API_KEY_HMAC_KEY') or os.environ['SECRET_KEY']).encode()
+
+
+def hash_api_key(api_key: str):
+    return hmac.new(API_KEY_HMAC_KEY, api_key.encode(), hashlib.sha256).hexdigest()
+
+
+class Credential(db.Model):
+    """API key of a User or UserNode, only its keyed hash is stored."""
+    key_hash = db.Column(
+        db.String(64),
+        primary_key=True
+    )
+    principal_type = db.Column(
+        db.String(16),
+        nullable=False
+    )
+    principal_id = db.Column(
+        db.String,
+        nullable=False,
+        index=True
+    )
+    time_created = db.Column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+    @classmethod
+    def issue(cls, principal_type, principal):
+        """Returns a new API key for principal, its previous keys stop working."""
+        if principal.id is None:
+            principal.id = str(uuid.uuid4())
+        with db.session.no_autoflush:
+            for old in cls.query.filter_by(principal_id=principal.id):
+                db.session.delete(old)
+        api_key = secrets.token_hex(32)
+        db.session.add(cls(key_hash=hash_api_key(api_key), principal_type=principal_type, principal_id=principal.id))
+        return api_key
+
 
 @dataclass
 class User(UserMixin, db.Model):
@@ -26,6 +71,11 @@ class User(UserMixin, db.Model):
 
     roles_list = [node_role, user_role]
 
+    # Order and seek of the keyset pages of GET /api/user
+    __table_args__ = (
+        db.Index('ix_user_time_created_id', 'time_created', 'id'),
+    )
+
     id = db.Column(
         db.String,
         default=lambda: str(uuid.uuid4()),
@@ -52,11 +102,8 @@ class User(UserMixin, db.Model):
         unique=True,
         nullable=False
     )
-    api_key = db.Column(
-        db.String(200),
-        unique=True,
-        nullable=False
-    )
+    # Not stored, only set right after generate_api_key
+    api_key = None
     time_created = db.Column(
         DateTime(timezone=True),
         server_default=func.now()
@@ -68,13 +115,16 @@ class User(UserMixin, db.Model):
     iot_users = db.relationship("UserNode", cascade="all, delete")
 
     def set_password(self, password):
-        self.password = generate_password_hash(password, "pbkdf2:sha3_512:500000")
+        self.password = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return verify_password(self.password, password)
+
+    def password_needs_upgrade(self):
+        return needs_upgrade(self.password)
 
     def generate_api_key(self):
-        self.api_key = secrets.token_hex(32)
+        self.api_key = Credential.issue(user_role, self)
 
     def has_roles(self, requirements):
         for req in requirements:
@@ -95,6 +145,14 @@ class UserNode(UserMixin, db.Model):
 
     roles_list = [node_role]
 
+    # Also serves lookups of a user's nodes, being its leftmost column
+    __table_args__ = (
+        db.Index('ix_user_node_user_id_domain', 'user_id', 'domain', unique=True),
+        db.Index('ix_user_node_domain', 'domain'),
+        # Order and seek of the keyset pages of GET /api/node
+        db.Index('ix_user_node_time_created_id', 'time_created', 'id'),
+    )
+
     id = db.Column(
         db.String,
         default=lambda: str(uuid.uuid4()),
@@ -108,11 +166,8 @@ class UserNode(UserMixin, db.Model):
         db.String(64),
         nullable=False
     )
-    api_key = db.Column(
-        db.String(200),
-        unique=True,
-        nullable=False
-    )
+    # Not stored, only set right after generate_api_key
+    api_key = None
     time_created = db.Column(
         DateTime(timezone=True),
         server_default=func.now()
@@ -123,7 +178,7 @@ class UserNode(UserMixin, db.Model):
     )
 
     def generate_api_key(self):
-        self.api_key = secrets.token_hex(32)
+        self.api_key = Credential.issue(node_role, self)
 
     def has_roles(self, requirements):
         for req in requirements:
@@ -146,3 +201,38 @@ class Admin(UserMixin):
             if req not in self.roles_list:
                 return False
         return True
+
+
+@event.listens_for(Session, 'before_flush')
+def delete_credentials(session, flush_context, instances):
+    """Keys of deleted users and nodes, including cascaded nodes, are deleted with them."""
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, (User, UserNode))]
+    if deleted:
+        with session.no_autoflush:
+            for credential in session.query(Credential).filter(Credential.principal_id.in_(deleted)):
+                session.delete(credential)
+
+
+@dataclass
+class Principal(UserMixin):
+    """Detached copy of an API-key authenticated User or UserNode, safe to keep in the auth cache."""
+    id: str
+    role: str
+    domain: str
+    user_id: Optional[str] = None
+    parent_domain: Optional[str] = None
+
+    @property
+    def roles_list(self):
+        return User.roles_list if self.role == user_role else UserNode.roles_list
+
+    @cached_property
+    def domain_path(self):
+        """Labels of the principal's domain inside the zone, node.user for nodes."""
+        return f"{self.domain}.{self.parent_domain}" if self.role == node_role else self.domain
+
+    def has_roles(self, requirements):
+        for req in requirements:
+            if req not in self.roles_list:
+                return False
+        return True
@@ -0,0 +1,125 @@
+import atexit
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from werkzeug.security import check_password_hash, gen_salt, generate_password_hash
+
+# Method of new hashes, either werkzeug's pbkdf2:<hash>:<iterations> or scrypt:<n>:<r>:<p>
+PASSWORD_METHOD = os.environ.get('PASSWORD_METHOD', 'pbkdf2:sha3_512:500000')
+# Rehash passwords stored with another method when their owner logs in
+PASSWORD_UPGRADE_ON_LOGIN = os.environ.get('PASSWORD_UPGRADE_ON_LOGIN', '0') == '1'
+# Hashing runs in this many processes per worker, 0 hashes inline in the request
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', 2))
+# Hashing jobs running or waiting at once. A login waits at most PASSWORD_QUEUE_TIMEOUT seconds
+# for its job to be queued and done, then fails with PasswordHashingBusy
+PASSWORD_MAX_PENDING = int(os.environ.get('PASSWORD_MAX_PENDING', 8))
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', 5))
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(PASSWORD_MAX_PENDING, 1))
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
+
+def _scrypt(password: str, salt: str, n: int, r: int, p: int):
+    return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p, maxmem=132 * n * r * p).hex()
+
+
+def _hash(password: str, method: str):
+    if method.startswith('scrypt:'):
+        n, r, p = (int(x) for x in method.split(':')[1:])
+        salt = gen_salt(16)
+        return f"{method}${salt}${_scrypt(password, salt, n, r, p)}"
+    return generate_password_hash(password, method)
+
+
+def _check(pwhash: str, password: str):
+    if pwhash.startswith('scrypt:'):
+        try:
+            method, salt, expected = pwhash.split('$', 2)
+            n, r, p = (int(x) for x in method.split(':')[1:])
+        except ValueError:
+            return False
+        return hmac.compare_digest(_scrypt(password, salt, n, r, p), expected)
+    return check_password_hash(pwhash, password)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn, since forking a worker with running threads is not safe
+                _executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context('spawn')
+                )
+                atexit.register(_executor.shutdown)
+    return _executor
+
+
+def _discard_executor(executor):
+    """Drops executor once one of its processes died, the next job starts a new one."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _submit(executor, func, args, deadline: float):
+    """Future of func(*args) on executor, holding one of the pending slots until it is done."""
+    if not _slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+        raise PasswordHashingBusy()
+    try:
+        future = executor.submit(func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def _run(func, *args):
+    if PASSWORD_WORKERS <= 0:
+        return func(*args)
+    deadline = time.monotonic() + PASSWORD_QUEUE_TIMEOUT
+    for attempt in range(2):
+        executor = _get_executor()
+        try:
+            future = _submit(executor, func, args, deadline)
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # a job already running keeps its slot until it ends
+            raise PasswordHashingBusy()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A hashing process was killed, e.g. running out of memory under scrypt
+            _discard_executor(executor)
+            if attempt:
+                raise
+
+
+def after_fork():
+    """Hashing processes belong to the process that started them, a forked worker starts its own."""
+    global _executor, _executor_lock, _slots
+    _executor = None
+    _executor_lock = threading.Lock()
+    _slots = threading.BoundedSemaphore(max(PASSWORD_MAX_PENDING, 1))
+
+
+def hash_password(password: str):
+    return _run(_hash, password, PASSWORD_METHOD)
+
+
+def verify_password(pwhash: str, password: str):
+    return _run(_check, pwhash, password)
+
+
+def needs_upgrade(pwhash: str):
+    return PASSWORD_UPGRADE_ON_LOGIN and not pwhash.startswith(f"{PASSWORD_METHOD}$")
@@ -0,0 +1,198 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import select
+import socket
+import threading
+import time
+import dns.asyncbackend
+import dns.asyncquery
+import dns.inet
+import dns.query
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Per-process pool of TCP connections to BIND reused by dynamic updates.
+    Idle connections are health checked before reuse, a request that fails
+    on a reused connection is retried once on a fresh one.
+    aquery keeps its own connections, bound to the event loop that opened them.
+    """
+
+    def __init__(self, server: str, port: int = 53, size: int = 4, timeout: float = 5, idle_timeout: float = 25):
+        self.server = server
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._idle = deque()  # (socket, time it was returned)
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._loop = None  # loop of the asyncio connections below
+        self._aidle = deque()
+        self._aslots = None
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0, 'discarded': 0, 'in_use': 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _connect(self):
+        sock = socket.create_connection((self.server, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _healthy(self, sock, returned):
+        if time.monotonic() - returned > self.idle_timeout:
+            return False
+        # An idle DNS connection must not be readable, if it is the server closed it
+        readable, _, _ = select.select([sock], [], [], 0)
+        return not readable
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                sock, returned = self._idle.pop()
+            if self._healthy(sock, returned):
+                self._count('hits')
+                return sock, True
+            self._count('discarded')
+            sock.close()
+        self._count('misses')
+        return self._connect(), False
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhausted(f"all {self.size} connections to {self.server} are busy")
+        self._count('in_use')
+        sock = None
+        try:
+            sock, reused = self._checkout()
+            yield sock, reused
+        except BaseException:
+            if sock is not None:
+                sock.close()
+            sock = None
+            raise
+        finally:
+            if sock is not None:
+                with self._lock:
+                    self._idle.append((sock, time.monotonic()))
+            self._count('in_use', -1)
+            self._slots.release()
+
+    def query(self, message, **kwargs):
+        """Same as dns.query.tcp(message, where=server) but over a pooled connection."""
+        reused = False
+        try:
+            with self.connection() as (sock, reused):
+                return dns.query.tcp(message, self.server, timeout=self.timeout, sock=sock, **kwargs)
+        except (OSError, EOFError):
+            if not reused:
+                raise
+        # The server dropped the connection after our health check, likely the idle ones too
+        self._count('reconnects')
+        self.close()
+        with self.connection() as (sock, reused):
+            return dns.query.tcp(message, self.server, timeout=self.timeout, sock=sock, **kwargs)
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+    def after_fork(self):
+        """Forgets the connections inherited from the parent process, which goes on using them."""
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._aidle = deque()
+        self._aslots = None
+        self.stats = dict.fromkeys(self.stats, 0)
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Connections of a previous loop cannot be used by this one
+            self._aidle = deque()
+            self._aslots = asyncio.BoundedSemaphore(self.size)
+            self._loop = loop
+
+    async def _aconnect(self):
+        backend = dns.asyncbackend.get_backend('asyncio')
+        sock = await backend.make_socket(
+            dns.inet.af_for_address(self.server), socket.SOCK_STREAM, destination=(self.server, self.port), timeout=self.timeout
+        )
+        raw = sock.writer.get_extra_info('socket')
+        if raw is not None:
+            raw.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _ahealthy(self, sock, returned):
+        if time.monotonic() - returned > self.idle_timeout:
+            return False
+        # The loop reads eagerly, a connection closed by the server is already at EOF
+        return not (sock.reader.at_eof() or sock.writer.is_closing())
+
+    async def _acheckout(self):
+        while self._aidle:
+            sock, returned = self._aidle.pop()
+            if self._ahealthy(sock, returned):
+                self._count('hits')
+                return sock, True
+            self._count('discarded')
+            await sock.close()
+        self._count('misses')
+        return await self._aconnect(), False
+
+    @asynccontextmanager
+    async def aconnection(self):
+        self._bind_loop()
+        slots = self._aslots
+        try:
+            await asyncio.wait_for(slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhausted(f"all {self.size} connections to {self.server} are busy") from None
+        self._count('in_use')
+        sock = None
+        try:
+            sock, reused = await self._acheckout()
+            yield sock, reused
+        except BaseException:
+            if sock is not None:
+                await sock.close()
+            sock = None
+            raise
+        finally:
+            if sock is not None and slots is self._aslots:
+                self._aidle.append((sock, time.monotonic()))
+            self._count('in_use', -1)
+            slots.release()
+
+    async def aquery(self, message, **kwargs):
+        """Same as query() but awaiting dns.asyncquery.tcp on a connection of the running loop."""
+        reused = False
+        try:
+            async with self.aconnection() as (sock, reused):
+                return await dns.asyncquery.tcp(message, self.server, timeout=self.timeout, sock=sock, **kwargs)
+        except (OSError, EOFError):
+            if not reused:
+                raise
+        self._count('reconnects')
+        await self.aclose()
+        async with self.aconnection() as (sock, reused):
+            return await dns.asyncquery.tcp(message, self.server, timeout=self.timeout, sock=sock, **kwargs)
+
+    async def aclose(self):
+        while self._aidle:
+            await self._aidle.pop()[0].close()
@@ -0,0 +1,201 @@
+"""
+Opt-in profiling of single requests.
+
+A request is profiled when it carries the admin API key in an X-Profile header, or is picked by
+PROFILE_SAMPLE_RATE. Its profile holds a cProfile summary, every SQL statement and every exchange
+with BIND, each with its timing, and is kept in the 'profiles' cache: GET /api/profile lists the
+recent ones, GET /api/profile/<id> returns one. Requests asking for it by header also get
+X-Profile-Id and Server-Timing response headers.
+
+Profiles are kept where CACHE_BACKEND says. With the default memory backend each worker keeps its own,
+so under several workers /api/profile only shows, and /api/profile/<id> only finds, the profiles of the
+worker answering it: set CACHE_BACKEND to a shared store there, as the Dockerfile does.
+
+When a request is not profiled the hooks only read a context variable.
+Exchange timings of concurrent queries overlap, so dns_ms may exceed total_ms.
+cProfile only sees the thread handling the request: async views served over WSGI run on a loop
+thread of their own and show up as a wait, under the ASGI server the profile of an async view
+also holds the other requests its event loop served meanwhile.
+"""
+from contextvars import ContextVar
+import datetime
+import hmac
+import io
+import os
+import random
+import threading
+import time
+import uuid
+import sqlalchemy as sa
+from flask import request
+
+from .cache import make_cache
+from .helpers import logger
+from . import metrics
+from .models import Admin
+
+# Fraction of requests profiled without being asked to, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# Profiles kept, and for how many seconds
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 100))
+PROFILE_TTL = float(os.environ.get('PROFILE_TTL', 3600))
+# Functions listed in the cProfile summary, by cumulative time
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', 40))
+
+# id -> profile, 'recent' -> summaries, per worker unless CACHE_BACKEND is shared
+profile_store = make_cache('profiles', PROFILE_KEEP, PROFILE_TTL)
+_current = ContextVar('request_profile', default=None)
+_recent_lock = threading.Lock()
+_thread = threading.local()  # one cProfile per thread, a second one would silently replace it
+
+
+class RequestProfile:
+    def __init__(self, requested: bool):
+        self.id = uuid.uuid4().hex
+        self.requested = requested
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.sql = []
+        self.dns = []
+        self._lock = threading.Lock()  # exchanges of one request may finish on other threads
+        self.profiler = None
+        if not getattr(_thread, 'profiling', False):
+            import cProfile  # only profiled requests need it
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+                _thread.profiling = True
+            except ValueError:
+                self.profiler = None  # another profiling tool is active
+
+    def offset_ms(self, at: float):
+        return round((at - self.start) * 1000, 3)
+
+    def add_statement(self, engine: str, statement: str, start: float, end: float):
+        with self._lock:
+            self.sql.append({
+                'engine': engine,
+                'statement': statement[:2000],
+                'at_ms': self.offset_ms(start),
+                'ms': round((end - start) * 1000, 3),
+            })
+
+    def add_exchange(self, op: str, detail: str, start: float, end: float, error: BaseException = None):
+        with self._lock:
+            self.dns.append({
+                'op': op,
+                'detail': detail,
+                'at_ms': self.offset_ms(start),
+                'ms': round((end - start) * 1000, 3),
+                'error': repr(error) if error is not None else None,
+            })
+
+    def server_timing(self):
+        total = (time.perf_counter() - self.start) * 1000
+        db_ms = sum(s['ms'] for s in self.sql)
+        dns_ms = sum(e['ms'] for e in self.dns)
+        return f'db;dur={db_ms:.3f}, dns;dur={dns_ms:.3f}, total;dur={total:.3f}'
+
+    def finish(self, status):
+        total_ms = round((time.perf_counter() - self.start) * 1000, 3)
+        summary = ''
+        if self.profiler is not None:
+            self.profiler.disable()
+            _thread.profiling = False
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            summary = stream.getvalue()
+        return {
+            'id': self.id,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'route': request.url_rule.rule if request.url_rule is not None else None,
+            'status': status,
+            'requested': self.requested,
+            'started': self.started.isoformat(),
+            'total_ms': total_ms,
+            'sql_ms': round(sum(s['ms'] for s in self.sql), 3),
+            'dns_ms': round(sum(e['ms'] for e in self.dns), 3),
+            'sql': self.sql,
+            'dns': self.dns,
+            'profile': summary,
+        }
+
+
+def wants_profile():
+    key = request.headers.get('X-Profile')
+    if key:
+        return hmac.compare_digest(key.encode(), Admin.api_key.encode())
+    return False
+
+
+def before_request():
+    if wants_profile():
+        _current.set(RequestProfile(requested=True))
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        _current.set(RequestProfile(requested=False))
+
+
+def after_request(response):
+    profile = _current.get()
+    if profile is not None:
+        profile.status = response.status_code
+        if profile.requested:
+            response.headers['X-Profile-Id'] = profile.id
+            response.headers['Server-Timing'] = profile.server_timing()
+    return response
+
+
+def teardown_request(exc):
+    profile = _current.get()
+    if profile is None:
+        return
+    _current.set(None)
+    result = profile.finish(getattr(profile, 'status', 500))
+    profile_store.set(profile.id, result)
+    remember(result)
+    logger.info(
+        f"Profiled {result['method']} {result['path']} as {profile.id}: {result['total_ms']} ms, "
+        f"{len(result['sql'])} statements in {result['sql_ms']} ms, {len(result['dns'])} exchanges in {result['dns_ms']} ms"
+    )
+
+
+def remember(result: dict):
+    """Adds result to the list of recent profiles, concurrent workers of a shared cache may lose an entry."""
+    summary = {k: result[k] for k in ('id', 'method', 'path', 'status', 'started', 'total_ms', 'sql_ms', 'dns_ms')}
+    with _recent_lock:
+        recent = profile_store.get('recent') or []
+        profile_store.set('recent', ([summary] + recent)[:PROFILE_KEEP])
+
+
+def record_exchange(op: str, detail: str, start: float, end: float, error: BaseException = None):
+    profile = _current.get()
+    if profile is not None:
+        profile.add_exchange(op, detail, start, end, error)
+
+
+def instrument_engine(engine, name: str):
+    """Records the statements of engine run by profiled requests."""
+
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current.get()
+        starts = conn.info.get('profile_start')
+        if profile is not None and starts:
+            profile.add_statement(name, statement, starts.pop(), time.perf_counter())
+
+
+def init_app(app, engines):
+    """Profiles requests of app that ask for it, recording the statements of its engines, by engine name."""
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    for name, engine in engines.items():
+        instrument_engine(engine, name)
+    metrics.exchange_listeners.append(record_exchange)
@@ -0,0 +1,33 @@
+from typing import Iterable
+
+from .models import User, UserNode
+
+# Fields of the JSON representation of each model, in this order
+NODE_SCHEMA = ('api_key', 'domain', 'id', 'time_created', 'time_updated', 'user_id')
+USER_SCHEMA = ('api_key', 'domain', 'email', 'id', 'name', 'time_created', 'time_updated')
+# Stored columns a listing can be projected to
+NODE_FIELDS = ('id', 'user_id', 'domain', 'time_created', 'time_updated')
+USER_FIELDS = ('id', 'name', 'email', 'domain', 'time_created', 'time_updated')
+
+
+def serialize_node(node: UserNode):
+    return {field: getattr(node, field) for field in NODE_SCHEMA}
+
+
+def serialize_user(user: User, nodes: bool = True):
+    """
+    User as a dict, with its nodes under iot_users unless nodes is False.
+    Listings should load iot_users with selectinload, otherwise every user costs a query.
+    """
+    result = {field: getattr(user, field) for field in USER_SCHEMA}
+    if nodes:
+        result['iot_users'] = [serialize_node(node) for node in user.iot_users]
+    return result
+
+
+def serialize_users(users: Iterable[User], nodes: bool = True):
+    return [serialize_user(user, nodes) for user in users]
+
+
+def serialize_nodes(nodes: Iterable[UserNode]):
+    return [serialize_node(node) for node in nodes]
@@ -0,0 +1,259 @@
+"""
+Stand-in for BIND used by load_test.py, so benchmarks run without a real name server.
+Serves one zone from memory over UDP and TCP: queries, TSIG-signed UPDATEs, AXFR and IXFR
+(from a journal of the updates it applied), each answered after a configurable latency.
+
+    python -m dns_manager.tests.bind_standin --zone example.com. --port 5353 --latency 0.005
+"""
+import argparse
+import socketserver
+import struct
+import threading
+import time
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdataset
+import dns.rdatatype
+import dns.rrset
+import dns.tsigkeyring
+import dns.zone
+
+# Records per message of a zone transfer, the transfer of a big zone spans many messages
+XFR_RRSETS_PER_MESSAGE = 500
+
+
+class StandinZone:
+    """The served zone and a journal of the changes UPDATEs made to it, for IXFR."""
+
+    def __init__(self, origin: str):
+        self.origin = dns.name.from_text(origin)
+        self.zone = dns.zone.from_text(
+            '@ 3600 IN SOA ns1 hostmaster 1 3600 600 86400 300\n'
+            '@ 3600 IN NS ns1\n'
+            'ns1 3600 IN A 127.0.0.1\n',
+            origin=self.origin,
+            relativize=False,
+        )
+        self.journal = []  # (old serial, new serial, deleted rrsets, added rrsets)
+        self.lock = threading.Lock()
+        self.stats = {'queries': 0, 'updates': 0, 'transfers': 0}
+
+    def soa(self):
+        return self.zone.find_rrset(self.origin, 'SOA')
+
+    def serial(self):
+        return self.soa()[0].serial
+
+    def answer(self, query):
+        self.stats['queries'] += 1
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        if not question.name.is_subdomain(self.origin):
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+        with self.lock:
+            node = self.zone.get_node(question.name)
+            if node is None:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+                response.authority.append(self.soa())
+                return response
+            rdataset = node.get_rdataset(dns.rdataclass.IN, question.rdtype)
+            cname = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.CNAME)
+            if rdataset is None and cname is not None:
+                rdataset = cname
+            if rdataset is None:
+                response.authority.append(self.soa())
+            else:
+                response.answer.append(dns.rrset.from_rdata_list(question.name, rdataset.ttl, list(rdataset)))
+        return response
+
+    def update(self, query):
+        """Applies the update section of query, prerequisites are not checked."""
+        self.stats['updates'] += 1
+        response = dns.message.make_response(query)
+        deleted, added = [], []
+        with self.lock:
+            for rrset in query.update:
+                if not rrset.name.is_subdomain(self.origin):
+                    response.set_rcode(dns.rcode.NOTZONE)
+                    return response
+                node = self.zone.get_node(rrset.name, create=True)
+                if rrset.deleting == dns.rdataclass.ANY:
+                    for rdataset in list(node.rdatasets):
+                        if rrset.rdtype in (dns.rdatatype.ANY, rdataset.rdtype):
+                            deleted.append(dns.rrset.from_rdata_list(rrset.name, rdataset.ttl, list(rdataset)))
+                            node.delete_rdataset(dns.rdataclass.IN, rdataset.rdtype)
+                elif rrset.deleting == dns.rdataclass.NONE:
+                    rdataset = node.get_rdataset(dns.rdataclass.IN, rrset.rdtype)
+                    for rdata in rrset:
+                        if rdataset is not None and rdata in rdataset:
+                            deleted.append(dns.rrset.from_rdata(rrset.name, rdataset.ttl, rdata))
+                            rdataset.discard(rdata)
+                    if rdataset is not None and not rdataset:
+                        node.delete_rdataset(dns.rdataclass.IN, rrset.rdtype)
+                else:
+                    rdataset = node.get_rdataset(dns.rdataclass.IN, rrset.rdtype, create=True)
+                    rdataset.update_ttl(rrset.ttl)
+                    for rdata in rrset:
+                        if rdata not in rdataset:
+                            rdataset.add(rdata)
+                            added.append(dns.rrset.from_rdata(rrset.name, rrset.ttl, rdata))
+                if not node.rdatasets:
+                    self.zone.delete_node(rrset.name)
+            if deleted or added:
+                soa = self.soa()
+                old = soa[0].serial
+                self.zone.replace_rdataset(self.origin, dns.rdataset.from_rdata(soa.ttl, soa[0].replace(serial=old + 1)))
+                self.journal.append((old, old + 1, deleted, added))
+        return response
+
+    def transfer(self, query):
+        """Messages of an AXFR, or of an IXFR when the journal reaches back to the client's serial."""
+        self.stats['transfers'] += 1
+        with self.lock:
+            soa = self.soa()
+            rrsets = []
+            if query.question[0].rdtype == dns.rdatatype.IXFR and query.authority:
+                client = query.authority[0][0].serial
+                entries = [entry for entry in self.journal if entry[0] >= client]
+                if client == soa[0].serial:
+                    rrsets = [soa]
+                elif entries and entries[0][0] == client:
+                    rrsets.append(soa)
+                    for old, new, deleted, added in entries:
+                        rrsets.append(dns.rrset.from_rdata(self.origin, soa.ttl, soa[0].replace(serial=old)))
+                        rrsets.extend(deleted)
+                        rrsets.append(dns.rrset.from_rdata(self.origin, soa.ttl, soa[0].replace(serial=new)))
+                        rrsets.extend(added)
+                    rrsets.append(soa)
+            if not rrsets:
+                rrsets.append(soa)
+                for name, node in self.zone.items():
+                    for rdataset in node:
+                        if name != self.origin or rdataset.rdtype != dns.rdatatype.SOA:
+                            rrsets.append(dns.rrset.from_rdata_list(name, rdataset.ttl, list(rdataset)))
+                rrsets.append(soa)
+        messages = []
+        for start in range(0, len(rrsets), XFR_RRSETS_PER_MESSAGE):
+            response = dns.message.make_response(query)
+            response.answer = rrsets[start:start + XFR_RRSETS_PER_MESSAGE]
+            messages.append(response)
+        return messages
+
+
+class StandinServer:
+    """UDP and TCP listeners of a StandinZone on host:port, each handled on its own thread."""
+
+    def __init__(self, zone: StandinZone, keyring, host: str = '127.0.0.1', port: int = 5353, latency: float = 0):
+        self.zone = zone
+        self.keyring = keyring
+        self.latency = latency
+        standin = self
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    data = self.receive()
+                    if data is None:
+                        return
+                    for message in standin.respond(data, tcp=True):
+                        wire = message.to_wire(max_size=65535)
+                        self.request.sendall(struct.pack('!H', len(wire)) + wire)
+
+            def receive(self):
+                length = self.read(2)
+                return self.read(struct.unpack('!H', length)[0]) if length else None
+
+            def read(self, n):
+                data = b''
+                while len(data) < n:
+                    chunk = self.request.recv(n - len(data))
+                    if not chunk:
+                        return None
+                    data += chunk
+                return data
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                for message in standin.respond(data, tcp=False):
+                    sock.sendto(message, self.client_address)
+
+        class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        class UDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.tcp = TCPServer((host, port), TCPHandler)
+        self.udp = UDPServer((host, self.tcp.server_address[1]), UDPHandler)
+        self.port = self.tcp.server_address[1]
+
+    def respond(self, data: bytes, tcp: bool):
+        """Response messages to a query, as messages over TCP and as wire data over UDP."""
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            query = dns.message.from_wire(data, keyring=self.keyring)
+        except dns.exception.DNSException:
+            return []
+        if query.opcode() == dns.opcode.UPDATE:
+            if not query.had_tsig:
+                response = dns.message.make_response(query)
+                response.set_rcode(dns.rcode.REFUSED)
+                return [response] if tcp else [response.to_wire()]
+            messages = [self.zone.update(query)]
+        elif query.question and query.question[0].rdtype in (dns.rdatatype.AXFR, dns.rdatatype.IXFR):
+            if not tcp:
+                return []
+            messages = self.zone.transfer(query)
+        else:
+            messages = [self.zone.answer(query)]
+        if tcp:
+            return messages
+        response = messages[0]
+        try:
+            return [response.to_wire(max_size=query.payload if query.edns >= 0 else 512)]
+        except dns.exception.TooBig:
+            truncated = dns.message.make_response(query)
+            truncated.flags |= dns.flags.TC
+            return [truncated.to_wire()]
+
+    def start(self):
+        for server in (self.tcp, self.udp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in (self.tcp, self.udp):
+            server.shutdown()
+            server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--zone', default='example.com.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before answering each message')
+    parser.add_argument('--tsig-name', default='tsig-key')
+    parser.add_argument('--tsig-secret', default='c2VjcmV0c2VjcmV0c2VjcmV0')
+    args = parser.parse_args()
+    keyring = dns.tsigkeyring.from_text({args.tsig_name: args.tsig_secret})
+    server = StandinServer(StandinZone(args.zone), keyring, args.host, args.port, args.latency).start()
+    print(f"Serving {args.zone} on {args.host}:{server.port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark of the JSON provider, encoding the responses of large listings and zone dumps
+with orjson and with the stdlib json module, and checking that both give the same output.
+
+    python -m dns_manager.tests.json_benchmark --users 1000 --nodes-per-user 5 --records 20000
+
+Payloads:
+- listing: GET /api/user, users serialized by schemas.py, each with its nodes
+- models: the same users returned as models, encoded field by field as dataclasses
+- zone: GET /api/dns/zone, records grouped by name
+"""
+import argparse
+import datetime
+import os
+import time
+import uuid
+
+# Read when dns_manager.models is imported, the benchmark uses neither
+os.environ.setdefault('SECRET_KEY', 'json-benchmark')
+os.environ.setdefault('ADMIN_API_KEY', 'json-benchmark')
+
+
+def users(count: int, nodes_per_user: int):
+    from dns_manager.models import User, UserNode
+
+    now = datetime.datetime(2023, 1, 1)
+    result = []
+    for i in range(count):
+        user = User(
+            id=str(uuid.uuid4()), name=f'user {i}', email=f'user{i}@example.com', domain=f'user{i}',
+            time_created=now + datetime.timedelta(seconds=i), time_updated=None,
+        )
+        user.iot_users = [
+            UserNode(
+                id=str(uuid.uuid4()), user_id=user.id, domain=f'node{j}',
+                time_created=now + datetime.timedelta(seconds=i, microseconds=j), time_updated=now,
+            )
+            for j in range(nodes_per_user)
+        ]
+        result.append(user)
+    return result
+
+
+def zone(records: int):
+    result = {'SOA': {'expire': 86400, 'minimum': 300, 'mname': 'ns1', 'refresh': 3600, 'retry': 600,
+                      'rname': 'hostmaster', 'serial': 1, 'ttl': 3600}, 'records': {}}
+    for i in range(records):
+        result['records'].setdefault(f'node{i % 5}.user{i // 5}', []).append(
+            {'response': f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 'rrtype': 'A', 'ttl': 3600}
+        )
+    return result
+
+
+def measure(provider, payload, repeat: int):
+    """Output of provider for payload and the best time of repeat runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = provider.response(payload).get_data()
+        best = min(best, time.perf_counter() - start)
+    return data, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--nodes-per-user', type=int, default=5)
+    parser.add_argument('--records', type=int, default=20000, help='records of the zone dump')
+    parser.add_argument('--repeat', type=int, default=10, help='runs of each payload, the best one is reported')
+    args = parser.parse_args()
+
+    from flask import Flask
+    from dns_manager.json_provider import FastJSONProvider, orjson
+    from dns_manager.schemas import serialize_users
+
+    app = Flask(__name__)
+    stdlib = FastJSONProvider(app)
+    stdlib.use_orjson = False
+    fast = FastJSONProvider(app)
+    if orjson is None:
+        print('orjson is not installed, both columns use the stdlib encoder')
+
+    models = users(args.users, args.nodes_per_user)
+    payloads = {
+        'listing': serialize_users(models),
+        'models': models,
+        'zone': zone(args.records),
+    }
+    print(f"{'payload':<10}{'bytes':>12}{'stdlib ms':>12}{'orjson ms':>12}{'speedup':>10}")
+    with app.app_context():
+        for name, payload in payloads.items():
+            expected, slow = measure(stdlib, payload, args.repeat)
+            data, quick = measure(fast, payload, args.repeat)
+            if data != expected:
+                raise SystemExit(f'{name}: the two encoders gave different output')
+            print(f'{name:<10}{len(data):>12}{slow * 1000:>12.1f}{quick * 1000:>12.1f}{slow / quick:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Offline load test: serves the app from a fresh SQLite database against bind_standin,
+drives a weighted mix of requests and reports throughput and latency percentiles per endpoint.
+
+    python -m dns_manager.tests.load_test --server uvicorn --workers 2 --duration 30 --latency 0.005
+
+Everything runs on this host: the stand-in and the app in subprocesses, the clients on threads of this one,
+each sending its next request once the previous one is answered. Results compare runs on the same machine only.
+App settings not set here (DNS_ANSWER_CACHE_TTL, PASSWORD_METHOD, ...) come from the environment,
+so a variant is measured by running the test again with them changed.
+
+Workloads:
+- checkin: a node replaces its A record, like a device reporting its address
+- read: a node looks up its A record
+- read_all: a node looks up all DNS_INTERESTING_TYPES of its name
+- zone: the admin dumps the whole zone
+- login: a user opens the log-in page and logs in with its password
+"""
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ZONE = 'example.com.'
+TSIG_USERNAME = 'tsig-key'
+TSIG_PASSWORD = 'c2VjcmV0c2VjcmV0c2VjcmV0'
+ADMIN_API_KEY = 'load-test-admin-key'
+PASSWORD = 'load-test-password'
+DEFAULT_MIX = 'checkin=50,read=25,read_all=10,zone=5,login=10'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def app_environment(database: str, bind_port: int):
+    """Environment of the app, pointed at the stand-in and the temporary database."""
+    env = dict(os.environ)
+    env.update({
+        'BIND_SERVER': '127.0.0.1',
+        'BIND_PORT': str(bind_port),
+        'BIND_ALLOWED_ZONES': ZONE,
+        'TSIG_USERNAME': TSIG_USERNAME,
+        'TSIG_PASSWORD': TSIG_PASSWORD,
+        'ADMIN_API_KEY': ADMIN_API_KEY,
+        'DATABASE_ADDRESS': f'sqlite:///{database}',
+        'DATABASE_READ_ADDRESS': '',
+    })
+    env.setdefault('SECRET_KEY', 'load-test-secret')
+    env.setdefault('INVITE_CODE', 'load-test')
+    env.setdefault('SERVER_ADDRESS', 'localhost')
+    return env
+
+
+def server_command(server: str, port: int, workers: int, threads: int, preload: bool):
+    if server == 'werkzeug':
+        return [sys.executable, '-c', (
+            'import logging; from werkzeug.serving import run_simple; from dns_manager import create_app; '
+            'logging.getLogger("werkzeug").setLevel(logging.WARNING); '
+            f'run_simple("127.0.0.1", {port}, create_app(), threaded=True)'
+        )]
+    if server == 'gunicorn':
+        return [
+            sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '-w', str(workers),
+            '--threads', str(threads), '--log-level', 'warning', *(['--preload'] if preload else []), 'dns_manager:create_app()',
+        ]
+    return [
+        sys.executable, '-m', 'uvicorn', '--factory', 'dns_manager.asgi:create_asgi_app', '--host', '127.0.0.1',
+        '--port', str(port), '--workers', str(workers), '--log-level', 'warning',
+    ]
+
+
+def server_description(args):
+    """How the app was served, werkzeug always runs one threaded process."""
+    if args.server == 'werkzeug':
+        return 'werkzeug, 1 process'
+    if args.server == 'gunicorn':
+        return f"gunicorn with {args.workers} workers of {args.threads} threads{', preloaded' if args.preload else ''}"
+    return f"uvicorn with {args.workers} workers"
+
+
+def seed(users: int, nodes_per_user: int):
+    """Creates the users and nodes of the test in the database, returns their API keys and domains."""
+    from dns_manager import create_app, db, migrations
+    from dns_manager.models import User, UserNode
+
+    app = create_app()
+    with app.app_context():
+        migrations.upgrade()
+        password = None
+        accounts, nodes = [], []
+        for i in range(users):
+            user = User(name=f'load{i}', email=f'load{i}@example.com', domain=f'load{i}')
+            if password is None:
+                user.set_password(PASSWORD)
+                password = user.password
+            user.password = password  # one hash for all, hashing is what login measures
+            user.generate_api_key()
+            db.session.add(user)
+            db.session.flush()
+            accounts.append({'email': user.email, 'api_key': user.api_key})
+            for j in range(nodes_per_user):
+                node = UserNode(user_id=user.id, domain=f'node{j}')
+                node.generate_api_key()
+                db.session.add(node)
+                nodes.append({'api_key': node.api_key, 'name': f'node{j}.load{i}.{ZONE}'})
+        db.session.commit()
+    return accounts, nodes
+
+
+def wait_for(port: int, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[:3]} exited with {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout} seconds")
+
+
+def stop(process: subprocess.Popen):
+    """Interrupts process, then kills whatever it started and left running, like the password hashing pool."""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+class Client:
+    """Keep-alive connection of one load thread, reopened after errors."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns status, headers and body of the response."""
+        headers = dict(headers or {})
+        if isinstance(body, dict):
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                return response.status, response.headers, response.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+
+class Results:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def timed(results, client, endpoint, expected, method, path, **kwargs):
+    start = time.perf_counter()
+    try:
+        status, headers, body = client.request(method, path, **kwargs)
+    except (http.client.HTTPException, OSError):
+        status, headers, body = None, {}, b''
+    results.add(endpoint, time.perf_counter() - start, status in expected)
+    return status, headers, body
+
+
+def checkin(client, results, rng, accounts, nodes):
+    node = rng.choice(nodes)
+    address = f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+    body = {'after': {'record_type': 'A', 'record_value': address, 'ttl': 300}}
+    timed(results, client, 'PUT /api/dns/record', (200, 202), 'PUT', f"/api/dns/record/{node['name']}",
+          body=body, headers={'X-Api-Key': node['api_key']})
+
+
+def read(client, results, rng, accounts, nodes):
+    node = rng.choice(nodes)
+    timed(results, client, 'GET /api/dns/record?record_type=A', (200,), 'GET',
+          f"/api/dns/record/{node['name']}?record_type=A", headers={'X-Api-Key': node['api_key']})
+
+
+def read_all(client, results, rng, accounts, nodes):
+    node = rng.choice(nodes)
+    timed(results, client, 'GET /api/dns/record', (200,), 'GET', f"/api/dns/record/{node['name']}",
+          headers={'X-Api-Key': node['api_key']})
+
+
+def zone(client, results, rng, accounts, nodes):
+    timed(results, client, 'GET /api/dns/zone', (200,), 'GET', f'/api/dns/zone/{ZONE}',
+          headers={'X-Api-Key': ADMIN_API_KEY})
+
+
+def login(client, results, rng, accounts, nodes):
+    account = rng.choice(accounts)
+    status, headers, body = timed(results, client, 'GET /login', (200,), 'GET', '/login')
+    token = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', body or b'')
+    cookie = (headers.get('Set-Cookie') or '').split(';', 1)[0]
+    if token is None or not cookie:
+        return
+    form = urllib.parse.urlencode({'email': account['email'], 'password': PASSWORD, 'csrf_token': token.group(1).decode()})
+    timed(results, client, 'POST /login', (302,), 'POST', '/login', body=form, headers={
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Cookie': cookie,
+    })
+
+
+WORKLOADS = {'checkin': checkin, 'read': read, 'read_all': read_all, 'zone': zone, 'login': login}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in WORKLOADS:
+            raise argparse.ArgumentTypeError(f"Unknown workload {name}, expected one of {', '.join(WORKLOADS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def run(port, mix, duration, concurrency, accounts, nodes, seed):
+    results = Results()
+    names, weights = list(mix), list(mix.values())
+    stop_at = time.monotonic() + duration
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        client = Client(port)
+        while time.monotonic() < stop_at:
+            WORKLOADS[rng.choices(names, weights)[0]](client, results, rng, accounts, nodes)
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return results, time.monotonic() - start
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an ordered list."""
+    return ordered[max(int(round(p / 100 * len(ordered))) - 1, 0)]
+
+
+def report(results, elapsed):
+    rows = []
+    for endpoint, latencies in sorted(results.latencies.items()):
+        ordered = sorted(latencies)
+        rows.append({
+            'endpoint': endpoint,
+            'requests': len(ordered),
+            'errors': results.errors[endpoint],
+            'rps': len(ordered) / elapsed,
+            'p50_ms': percentile(ordered, 50) * 1000,
+            'p95_ms': percentile(ordered, 95) * 1000,
+            'p99_ms': percentile(ordered, 99) * 1000,
+            'max_ms': ordered[-1] * 1000,
+        })
+    return rows
+
+
+def print_report(rows, elapsed):
+    print(f"{'endpoint':36} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for row in rows:
+        print(
+            f"{row['endpoint']:36} {row['requests']:>9} {row['errors']:>7} {row['rps']:>9.1f} "
+            f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}"
+        )
+    total = sum(row['requests'] for row in rows)
+    print(f"{'total':36} {total:>9} {sum(row['errors'] for row in rows):>7} {total / elapsed:>9.1f}   in {elapsed:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn', 'uvicorn'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes of gunicorn and uvicorn')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gunicorn worker')
+    parser.add_argument('--preload', action='store_true', help='load the app before forking gunicorn workers')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to send requests for')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients sending requests at once')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--nodes-per-user', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds the stand-in waits before each answer')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'workload weights, default {DEFAULT_MIX}')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the request sequence of each client')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='dns_manager_load_') as workdir:
+        bind_port = free_port()
+        env = app_environment(os.path.join(workdir, 'load.db'), bind_port)
+        os.environ.update(env)  # seed() imports the app in this process
+        processes = []
+        try:
+            standin = subprocess.Popen(
+                [sys.executable, '-m', 'dns_manager.tests.bind_standin', '--zone', ZONE, '--port', str(bind_port),
+                 '--latency', str(args.latency), '--tsig-name', TSIG_USERNAME, '--tsig-secret', TSIG_PASSWORD],
+                env=env, stdout=subprocess.DEVNULL, start_new_session=True,
+            )
+            processes.append(standin)
+            accounts, nodes = seed(args.users, args.nodes_per_user)
+
+            port = free_port()
+            app = subprocess.Popen(server_command(args.server, port, args.workers, args.threads, args.preload), env=env, start_new_session=True)
+            processes.append(app)
+            wait_for(bind_port, standin)
+            wait_for(port, app)
+
+            # Every node publishes its address once, so reads and zone dumps find records
+            warmup = Results()
+            with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+                clients = threading.local()
+
+                def publish(n):
+                    if not hasattr(clients, 'client'):
+                        clients.client = Client(port)
+                    checkin(clients.client, warmup, random.Random(n), accounts, [nodes[n]])
+                list(executor.map(publish, range(len(nodes))))
+            if sum(warmup.errors.values()):
+                print(f"Warning: {sum(warmup.errors.values())} of {len(nodes)} warm-up check-ins failed", file=sys.stderr)
+
+            print(
+                f"{server_description(args)}, {args.concurrency} clients for {args.duration:g} s, "
+                f"{len(nodes)} nodes, stand-in latency {args.latency * 1000:g} ms"
+            )
+            results, elapsed = run(port, args.mix, args.duration, args.concurrency, accounts, nodes, args.seed)
+        finally:
+            for process in reversed(processes):
+                stop(process)
+
+    rows = report(results, elapsed)
+    print_report(rows, elapsed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            settings = {k: v for k, v in vars(args).items() if k != 'json'}
+            settings['served_by'] = server_description(args)
+            json.dump({'settings': settings, 'elapsed': elapsed, 'endpoints': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Flushes run in a background thread, without an app context for helpers.logger
+logger = logging.getLogger(__name__)
+
+
+def coalesce(operations: List[dict], op: dict):
+    """
+    Adds op to the operations queued for one (name, record type).
+    A replace without 'before' or a delete of the whole RRset makes everything queued before it irrelevant,
+    an operation identical to a queued one is not queued twice.
+    Returns how many operations were dropped.
+    """
+    dropped = 0
+    if (op['action'] == 'replace' and not op.get('before')) or (op['action'] == 'delete' and not op.get('record_value')):
+        dropped = len(operations)
+        operations.clear()
+    if op in operations:
+        return dropped + 1
+    operations.append(op)
+    return dropped
+
+
+class CoalescingQueue:
+    """
+    Write-behind queue of record operations, stored as BatchOperation dicts.
+    A background thread hands what is pending to flush every interval seconds,
+    flush returns the operations to retry later and the ones BIND rejected.
+    With a journal every queued operation is also appended to a file of this process, locked while it runs,
+    and the next process to start replays the files no process holds a lock on anymore.
+    With a shared cache, flushes requested in one process are run by every process using it.
+    """
+
+    def __init__(self, flush: Callable[[List[dict]], Tuple[List[dict], List[dict]]], interval: float,
+                 journal: Optional[str] = None, fsync: bool = False, shared=None):
+        self.flush_operations = flush
+        self.interval = interval
+        self.journal = journal
+        self.fsync = fsync
+        self.shared = shared
+        self._pending: Dict[Tuple[str, str], List[dict]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._journal_file = None
+        self._flushed_at = 0.0
+        self.stats = {'queued': 0, 'coalesced': 0, 'flushed': 0, 'retried': 0, 'rejected': 0, 'pending': 0}
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    @staticmethod
+    def key(op: dict):
+        return op['domain'].lower(), op['record_type'].upper()
+
+    def start(self):
+        """Opens the journal, replaying those of dead processes, and starts the flushing thread once per process."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            if self.journal:
+                self._open_journal()
+                # Replayed operations are older than any the requests of this process will send
+                if self._pending:
+                    self._wakeup.set()
+            self._thread = threading.Thread(target=self._run, name='dns-write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def after_fork(self):
+        """
+        Starts over in a forked worker: operations queued by the parent are flushed by the parent,
+        and the flushing thread and journal are the parent's too.
+        """
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._journal_file = None
+        self._flushed_at = 0.0
+        self.stats = dict.fromkeys(self.stats, 0)
+
+    def pending(self, domain: str, record_type: str):
+        """True when operations on this name and type are still waiting for a flush."""
+        return bool(self._pending.get(self.key({'domain': domain, 'record_type': record_type})))
+
+    def put(self, op: dict):
+        self.start()
+        with self._lock:
+            self.stats['queued'] += 1
+            self.stats['coalesced'] += coalesce(self._pending.setdefault(self.key(op), []), op)
+            self._update_pending()
+            if self._journal_file is not None:
+                self._journal_file.write(json.dumps(op) + '\n')
+                self._journal_file.flush()
+                if self.fsync:
+                    os.fsync(self._journal_file.fileno())
+
+    def flush(self):
+        """Sends everything pending right away, returns the number of operations sent."""
+        with self._flush_lock:
+            self._flushed_at = time.time()
+            with self._lock:
+                operations = [op for ops in self._pending.values() for op in ops]
+                self._pending = {}
+            if not operations:
+                return 0
+            try:
+                retry, rejected = self.flush_operations(operations)
+            except Exception as e:
+                logger.warning(f"Write-behind flush failed: {e}")
+                retry, rejected = operations, []
+            for op in rejected:
+                logger.warning(f"Queued {op['action']} of {op['record_type']} {op['domain']} was rejected")
+            with self._lock:
+                newer, self._pending = self._pending, {}
+                # Retried operations go before anything queued during the flush
+                for op in retry + [op for ops in newer.values() for op in ops]:
+                    coalesce(self._pending.setdefault(self.key(op), []), op)
+                self.stats['flushed'] += len(operations) - len(retry)
+                self.stats['retried'] += len(retry)
+                self.stats['rejected'] += len(rejected)
+                self._update_pending()
+                self._rewrite_journal()
+            return len(operations) - len(retry)
+
+    def request_flush(self):
+        """Flushes this process right away, the others sharing the cache flush within a second."""
+        if self.shared is not None:
+            self.shared.set('flush', time.time())
+        return self.flush()
+
+    def _flush_requested(self):
+        return self.shared is not None and (self.shared.get('flush') or 0) > self._flushed_at
+
+    def _run(self):
+        while True:
+            # Woken up every second at least, to see flushes requested by other processes
+            woken = self._wakeup.wait(min(self.interval, 1))
+            self._wakeup.clear()
+            if not woken and time.time() - self._flushed_at < self.interval and not self._flush_requested():
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Write-behind flush failed: {e}")
+
+    def _update_pending(self):
+        self.stats['pending'] = sum(len(ops) for ops in self._pending.values())
+
+    def _open_journal(self):
+        # A unique name, a process reusing the PID of a dead one must not take over its file.
+        # Locked before it is renamed to it, other processes replay the journals they can lock.
+        name = f"{os.getpid()}.{uuid.uuid4().hex}"
+        path = f"{self.journal}.{name}"
+        self._journal_file = open(f"{self.journal}-{name}", 'a+')
+        fcntl.flock(self._journal_file, fcntl.LOCK_EX)
+        os.rename(self._journal_file.name, path)
+        for orphan in glob.glob(f"{glob.escape(self.journal)}.*"):
+            if orphan != path:
+                self._replay(orphan)
+        self._rewrite_journal()
+
+    def _replay(self, path):
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            return  # replayed by another process
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # its owner is alive and flushes it
+            if os.fstat(f.fileno()).st_nlink == 0:
+                return  # removed by the process that replayed it before we got the lock
+            replayed = 0
+            for line in f:
+                if line.strip():
+                    op = json.loads(line)
+                    coalesce(self._pending.setdefault(self.key(op), []), op)
+                    replayed += 1
+            os.remove(path)
+        self._update_pending()
+        logger.info(f"Replayed {replayed} queued DNS operations from {path}")
+
+    def _rewrite_journal(self):
+        if self._journal_file is None:
+            return
+        self._journal_file.seek(0)
+        self._journal_file.truncate()
+        for ops in self._pending.values():
+            for op in ops:
+                self._journal_file.write(json.dumps(op) + '\n')
+        self._journal_file.flush()
+        if self.fsync:
+            os.fsync(self._journal_file.fileno())
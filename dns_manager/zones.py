@@ -0,0 +1,305 @@
+import bisect
+from collections import defaultdict
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+import dns.message
+import dns.name
+import dns.query
+import dns.rdatatype
+import dns.versioned
+import dns.zone
+
+from .cache import make_cache
+from .metrics import bind_timer
+
+# Also used from the mirror thread, where there is no app context for helpers.logger
+logger = logging.getLogger(__name__)
+
+
+def transfer_zone(server: str, domain: str, port: int = 53) -> dns.zone.Zone:
+    with bind_timer('xfr', f'AXFR {domain}'):
+        return dns.zone.from_xfr(dns.query.xfr(server, domain, port=port))
+
+
+def zone_serial(zone: dns.zone.Zone) -> Optional[int]:
+    soa = zone.get_rdataset(zone.origin, 'SOA')
+    return soa[0].serial if soa else None
+
+
+def iterate_zone(server: str, domain: str, zone: Optional[dns.zone.Zone] = None, port: int = 53):
+    """
+    Returns the zone SOA as (ttl, rdata) and an iterator over (name, ttl, rdata) of all records.
+    Without a zone the records come straight from an AXFR, message by message,
+    so the whole zone is never held in memory.
+    """
+    if zone is not None:
+        soa = zone.get_rdataset(zone.origin, 'SOA')
+        return (soa.ttl, soa[0]), zone.iterate_rdatas()
+
+    def transferred():
+        seen_soa = False
+        # Includes the time the consumer takes between messages
+        with bind_timer('xfr', f'AXFR {domain}'):
+            for message in dns.query.xfr(server, domain, port=port):
+                for rrset in message.answer:
+                    if rrset.rdtype == dns.rdatatype.SOA:
+                        if seen_soa:
+                            return  # closing SOA of the transfer
+                        seen_soa = True
+                    for rdata in rrset:
+                        yield rrset.name, rrset.ttl, rdata
+
+    rdatas = transferred()
+    first = next(rdatas)
+    return (first[1], first[2]), itertools.chain([first], rdatas)
+
+
+def select_records(rdatas, prefix: Optional[dns.name.Name] = None, cursor: Optional[dns.name.Name] = None, limit: int = 0):
+    """
+    Keeps records owned by names at or below prefix and sorting after cursor.
+    With a limit only the first limit owner names in DNS order are kept, in one pass
+    and with memory for that page only.
+    Returns the records and the cursor of the next page (None on the last one).
+    """
+    def matching():
+        for (name, ttl, rdata) in rdatas:
+            if prefix is not None and not name.is_subdomain(prefix):
+                continue
+            if cursor is not None and name <= cursor:
+                continue
+            yield name, ttl, rdata
+
+    if not limit:
+        return matching(), None
+    names = []
+    page = defaultdict(list)
+    more = False
+    for (name, ttl, rdata) in matching():
+        if name not in page:
+            if len(names) == limit and name > names[-1]:
+                more = True
+                continue
+            bisect.insort(names, name)
+            if len(names) > limit:
+                more = True
+                del page[names.pop()]
+        page[name].append((name, ttl, rdata))
+    records = [record for name in names for record in page[name]]
+    return records, (names[-1].to_text() if more else None)
+
+
+class ZoneSnapshot:
+    """Zone transferred once and indexed by absolute owner name, then by rdatatype name."""
+
+    def __init__(self, zone: dns.zone.Zone, fetched: Optional[float] = None):
+        self.zone = zone
+        self.serial = zone_serial(zone)
+        self.created = time.monotonic()
+        # Wall-clock time the transfer of zone started, writes made after it may be missing
+        self.fetched = time.time() if fetched is None else fetched
+        self.names: Dict[str, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+        for (name, ttl, rdata) in zone.iterate_rdatas():
+            owner = name.derelativize(zone.origin).to_text().lower()
+            # Same text the resolver gives for answers, i.e. with absolute names
+            self.names[owner][dns.rdatatype.to_text(rdata.rdtype)].append(
+                rdata.to_text(origin=zone.origin, relativize=False)
+            )
+
+    def records(self, domain: str, record_types: List[str]):
+        """
+        Records of domain in the same shape as live resolution.
+        Returns None when the snapshot cannot answer for that name.
+        """
+        node = self.names.get(domain.lower())
+        if node is None:
+            return None
+        if 'CNAME' in node and any(t.upper() != 'CNAME' for t in record_types):
+            return None  # resolver would follow the alias
+        return {t: list(node[t.upper()]) for t in record_types if t.upper() in node}
+
+
+class ZoneMirror:
+    """
+    In-memory copies of zones kept up to date by a background thread.
+    The SOA serial is polled every interval seconds, a changed serial is followed
+    by an IXFR applied to the local copy, and a full AXFR is only done when IXFR fails.
+    """
+
+    def __init__(self, server: str, zone_names: List[str], interval: float, timeout: float = 5, port: int = 53):
+        self.server = server
+        self.port = port
+        self.zone_names = [dns.name.from_text(name) for name in zone_names]
+        self.interval = interval
+        self.timeout = timeout
+        self._zones: Dict[dns.name.Name, dns.versioned.Zone] = {}
+        self._synced: Dict[dns.name.Name, float] = {}
+        self._fetched: Dict[dns.name.Name, float] = {}  # wall-clock start of the transfer that last changed each zone
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        """Starts the polling thread once per process, so it is safe to call on every request."""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='zone-mirror', daemon=True)
+                self._thread.start()
+
+    def refresh_soon(self):
+        self._wakeup.set()
+
+    def after_fork(self):
+        """The polling thread does not survive a fork, the next get starts one in the worker."""
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def get(self, zone_name: str) -> Optional[dns.versioned.Zone]:
+        """Mirrored zone, or None when it is missing or has not synced for a few intervals."""
+        self.start()
+        name = dns.name.from_text(zone_name)
+        synced = self._synced.get(name)
+        if synced is None or time.monotonic() - synced > 3 * self.interval + self.timeout:
+            return None
+        return self._zones.get(name)
+
+    def fetched(self, zone_name: str) -> float:
+        """When the transfer that brought the mirrored zone to its current serial started, as time.time()."""
+        return self._fetched.get(dns.name.from_text(zone_name), 0.0)
+
+    def _run(self):
+        while True:
+            for name in self.zone_names:
+                try:
+                    self.sync(name)
+                except Exception as e:
+                    logger.warning(f"Zone mirror of {name} failed: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def remote_serial(self, name: dns.name.Name) -> int:
+        query = dns.message.make_query(name, 'SOA')
+        with bind_timer('query', f'{name} SOA'):
+            response = dns.query.udp(query, self.server, timeout=self.timeout, port=self.port)
+        return response.find_rrset(response.answer, name, query.question[0].rdclass, dns.rdatatype.SOA)[0].serial
+
+    def sync(self, name: dns.name.Name):
+        started = time.time()
+        zone = self._zones.get(name)
+        if zone is not None and zone_serial(zone) == self.remote_serial(name):
+            self._synced[name] = time.monotonic()
+            return
+        if zone is not None:
+            try:
+                # IXFR from the serial we hold, the transfer is applied as one transaction
+                with bind_timer('xfr', f'IXFR {name}'):
+                    dns.query.inbound_xfr(self.server, zone, port=self.port, lifetime=self.timeout * 10)
+                self._fetched[name] = started
+                self._synced[name] = time.monotonic()
+                return
+            except Exception as e:
+                logger.info(f"IXFR of {name} failed, falling back to AXFR: {e}")
+        fresh = dns.versioned.Zone(name)
+        with bind_timer('xfr', f'AXFR {name}'):
+            dns.query.inbound_xfr(self.server, fresh, port=self.port, lifetime=self.timeout * 10)
+        self._zones[name] = fresh
+        self._fetched[name] = started
+        self._synced[name] = time.monotonic()
+
+
+class SnapshotStore:
+    """
+    Keeps one snapshot of the allowed zone, transferring it again once it is older than ttl.
+    When a zone mirror is running the snapshot is rebuilt from it whenever its serial changes.
+    Names written since their snapshot was transferred are not answered from it, in every worker
+    sharing CACHE_BACKEND, and a failed transfer is retried after a backoff of up to ttl.
+    """
+
+    def __init__(self, server: str, zone_name: str, ttl: float, mirror: Optional[ZoneMirror] = None, port: int = 53):
+        self.server = server
+        self.port = port
+        self.zone_name = zone_name
+        self.ttl = ttl
+        self.mirror = mirror
+        self._snapshot: Optional[ZoneSnapshot] = None
+        self._lock = threading.Lock()
+        self._retry_at = 0.0
+        self._retry_delay = 1.0
+        # owner name -> time.time() of its last write, kept as long as a snapshot from before it may be served
+        lifetime = ttl + (3 * mirror.interval + mirror.timeout if mirror is not None and mirror.enabled else 0)
+        self.written = make_cache('snapshot_writes', 100000, lifetime)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def covers(self, domain: str):
+        return self.enabled and dns.name.from_text(domain).is_subdomain(dns.name.from_text(self.zone_name))
+
+    def _fresh(self) -> Optional[ZoneSnapshot]:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.created < self.ttl:
+            return snapshot
+        return None
+
+    def get(self) -> Optional[ZoneSnapshot]:
+        """Current snapshot, None while it cannot be had without waiting for or retrying a transfer."""
+        mirrored = self.mirror.get(self.zone_name) if self.mirror is not None and self.mirror.enabled else None
+        if mirrored is not None:
+            snapshot = self._snapshot
+            # An IXFR changes the zone in place before the mirror records when it started
+            fetched = self.mirror.fetched(self.zone_name)
+            if snapshot is None or snapshot.zone is not mirrored or snapshot.serial != zone_serial(mirrored) \
+                    or snapshot.fetched != fetched:
+                snapshot = self._snapshot = ZoneSnapshot(mirrored, fetched)
+            return snapshot
+        snapshot = self._fresh()
+        if snapshot is not None or time.monotonic() < self._retry_at:
+            return snapshot
+        # Requests arriving during the transfer resolve live instead of waiting for it
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            snapshot = self._fresh()
+            if snapshot is not None:
+                return snapshot
+            try:
+                started = time.time()
+                self._snapshot = ZoneSnapshot(transfer_zone(self.server, self.zone_name, self.port), started)
+                self._retry_delay = 1.0
+            except Exception as e:
+                logger.warning(f"Zone snapshot of {self.zone_name} failed, retrying in {self._retry_delay:g} s: {e}")
+                self._snapshot = None
+                self._retry_at = time.monotonic() + self._retry_delay
+                self._retry_delay = min(self._retry_delay * 2, self.ttl)
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def records(self, domain: str, record_types: List[str]):
+        if not self.covers(domain):
+            return None
+        snapshot = self.get()
+        if snapshot is None:
+            return None
+        written = self.written.get(domain.lower())
+        if written is not None and written >= snapshot.fetched:
+            return None
+        return snapshot.records(domain, record_types)
+
+    def invalidate(self, *domains: str):
+        """Stops answering for domains from snapshots transferred before now, they are resolved live instead."""
+        now = time.time()
+        for domain in domains:
+            self.written.set(domain.lower(), now)
+        if self.mirror is not None and self.mirror.enabled:
+            self.mirror.refresh_soon()
@@ -0,0 +1,32 @@
+# Read by gunicorn when started from this directory, settings given on the command line take precedence.
+# Start with --preload to load the app once and share its memory with the workers, run
+# `flask --app dns_manager upgrade-db` before, create_app no longer creates the schema.
+import os
+import shutil
+
+
+def on_starting(server):
+    # Samples of a previous run would be added to the new ones, see dns_manager/metrics.py
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    # With --preload workers inherit the app the arbiter loaded, and with it its connections
+    if server.cfg.preload_app:
+        from dns_manager import after_fork
+        after_fork(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    # Queued DNS operations of dead workers are replayed when a worker starts, not on its first request
+    from dns_manager import dns
+    dns.start_write_behind()
@@ -6,7 +6,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        'Flask==2.2.2',
+        'Flask[async]==2.2.2',
         'Flask-Login==0.6.2',
         'SQLAlchemy==1.4.46',
         'Flask-SQLAlchemy==3.0.2',
@@ -16,6 +16,11 @@ setup(
         'email-validator==1.3.0',
         'blinker==1.5',
         'pydantic==1.10.4',
-        'Flask-Pydantic==0.11.0'
+        'Flask-Pydantic==0.11.0',
+        'prometheus-client==0.16.0'
     ],
+    extras_require={
+        # Faster JSON responses, see dns_manager/json_provider.py
+        'orjson': ['orjson==3.8.3'],
+    },
 )
\ No newline at end of file